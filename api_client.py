@@ -1,159 +1,396 @@
 import spotipy
-import spotipy.util as util
 
 import sql_utils
 
-import pandas as pd
+from http_cache import CachingSession, HTTPCache
+
+from metrics import run_metrics
+
+from request_scheduler import RequestScheduler
+
+from token_manager import TokenManager
+
+from concurrent.futures import ThreadPoolExecutor
+
+from collections import deque
 
 from datetime import datetime
 
-import json
+import logging
 
 
 # APIClient handles collection of data from Spotify API into a local database
 class APIClient:
 
-    def __init__(self):
+    ARTIST_BATCH_SIZE = 50
+    ALBUM_BATCH_SIZE = 20
+    NEW_RELEASES_PAGE_SIZE = 50
+
+    # Columns of tables that data obtained from API is inserted into
+    album_columns = ["AlbumID", "CollectionDate", "Name", "ReleaseDate", "ImageURL"]
+    artist_columns = ["ArtistID", "Name", "Popularity"]
+    artist_genre_columns = ["ArtistID", "Genre"]
+    album_artist_columns = ["AlbumID", "ArtistID"]
+    track_columns = ["TrackID", "SingleCollectionDate", "Name", "PreviewURL", "SingleTrackNumber",
+                     "SingleReleaseDate", "SingleImageURL"]
+    track_artist_columns = ["TrackID", "ArtistID"]
+    album_track_columns = ["AlbumID", "TrackID", "TrackNumber"]
+
+    def __init__(self, config, session):
+
+        self.config = config
+
+        # Use the run's connection to local database
+        self.conn = session.conn
+
+        # Responses of resources that haven't changed since they were last requested are served from a cache
+        # next to the local database, and rate limited responses and server errors are left to the request
+        # scheduler so that Retry-After is honoured by every worker
+        self.http_cache = HTTPCache(session.http_cache_conn, int(self.config.http_cache_max_mb * 1000000))
+        http_session = CachingSession(self.http_cache)
+
+        # Tokens are obtained with the application's credentials from config.json, none of the endpoints used
+        # needing access to a user's data, and the first one is obtained now so that bad credentials fail early
+        self.token_manager = TokenManager(self.config.spotify_client_id, self.config.spotify_client_secret,
+                                          http_session)
+        self.token_manager.get_access_token()
+        print("Got token\n")
+
+        # Spotipy logs the headers of every request at debug level, which would include the token
+        logging.getLogger("spotipy").setLevel(max(logging.getLogger("spotipy").getEffectiveLevel(), logging.INFO))
+        self.sp = spotipy.Spotify(auth_manager=self.token_manager, requests_session=http_session)
+        if self.config.spotify_api_prefix:
+            self.sp.prefix = self.config.spotify_api_prefix
+
+        # Send API requests concurrently while staying within Spotify's rate limits
+        self.scheduler = RequestScheduler(self.config.fetch_workers,
+                                          self.config.requests_per_second,
+                                          self.config.max_request_retries)
+
+        self._reset_buffers()
+
+        # Full artist objects obtained during this run, keyed by ArtistID
+        self.artist_cache = {}
+
+        # Artist objects that were fetched from the API (rather than the local cache) during this run
+        self.fetched_artists = []
+
+    # Define row buffers that collect data parsed from API as tuples in the column order of each table
+    def _reset_buffers(self):
+        self.album_rows = []
+        self.artist_rows = []
+        self.artist_genre_rows = []
+        self.album_artist_rows = []
+        self.track_rows = []
+        self.track_artist_rows = []
+        self.album_track_rows = []
+
+        # Ids of the releases read from the new release feed of each market, keyed by market
+        self.market_release_ids = {}
+
+    # Insert new albums into local database, counting the albums that were new to it in the metrics report
+    @run_metrics.timed("insert_albums")
+    def _insert_albums(self):
+        run_metrics.count("new_albums", len(sql_utils.insert_new_rows(self.conn, "Albums", self.album_columns,
+                                                                      ["AlbumID"], self.album_rows)))
 
-        with open("config.json") as config_file:
-            self.config = json.load(config_file)
+    # Insert new artists into local database, counting the artists that were new to it in the metrics report
+    @run_metrics.timed("insert_artists")
+    def _insert_artists(self):
+        self.new_artist_ids = set(sql_utils.insert_new_rows(self.conn, "Artists", self.artist_columns, ["ArtistID"],
+                                                            self.artist_rows))
+        run_metrics.count("new_artists", len(self.new_artist_ids))
 
-        # Obtain information needed to access API from config.json
-        username = self.config["spotify_username"]
-        client_id = self.config["spotify_client_id"]
-        client_secret = self.config["spotify_client_secret"]
-        redirect_uri = self.config["spotify_redirect_uri"]
+    # Insert genres related to new artists into local database
+    @run_metrics.timed("insert_artist_genre")
+    def _insert_artist_genre(self):
+        sql_utils.insert_new_rows(self.conn, "Artist_Genre", self.artist_genre_columns, ["ArtistID", "Genre"],
+                                  self.artist_genre_rows)
 
-        # Connect to local database
-        self.conn = sql_utils.create_sqlite_connection()
+    # Insert album to artist relationships into local database
+    @run_metrics.timed("insert_album_artist")
+    def _insert_album_artist(self):
+        sql_utils.insert_new_rows(self.conn, "Album_Artist", self.album_artist_columns, ["AlbumID", "ArtistID"],
+                                  self.album_artist_rows)
 
-        print("Asked for token")
+    # Insert new tracks into local database, counting the tracks that were new to it in the metrics report
+    @run_metrics.timed("insert_tracks")
+    def _insert_tracks(self):
+        run_metrics.count("new_tracks", len(sql_utils.insert_new_rows(self.conn, "Tracks", self.track_columns,
+                                                                      ["TrackID"], self.track_rows)))
 
-        # Obtain token to access API
-        token = util.prompt_for_user_token(username,
-                                           None,
-                                           client_id,
-                                           client_secret,
-                                           redirect_uri)
+    # Insert track to artist relationships into local database
+    @run_metrics.timed("insert_track_artist")
+    def _insert_track_artist(self):
+        sql_utils.insert_new_rows(self.conn, "Track_Artist", self.track_artist_columns, ["TrackID", "ArtistID"],
+                                  self.track_artist_rows)
 
-        if token:
-            print("Got token\n")
-            print("Token: " + token + "\n")
-            self.sp = spotipy.Spotify(auth=token)
-        else:
-            raise Exception("Can't get token")
+    # Insert album to track relationships into local database
+    @run_metrics.timed("insert_album_track")
+    def _insert_album_track(self):
+        sql_utils.insert_new_rows(self.conn, "Album_Track", self.album_track_columns, ["AlbumID", "TrackID"],
+                                  self.album_track_rows)
+
+    # Obtain every track of the given albums and singles, keyed by release id, loading releases in batches along with
+    # their first page of tracks and following the track pages only of releases with more tracks than fit on one
+    # (this runs in the background, so its time is measured by the given stage waiting for it, which its requests
+    # are credited to)
+    def _load_release_tracks(self, stage, release_ids):
+        with run_metrics.in_stage(stage):
+            return self._request_release_tracks(release_ids)
+
+    def _request_release_tracks(self, release_ids):
+        release_tracks = {release_id: {"items": []} for release_id in release_ids}
+
+        # Several albums endpoint accepts up to 20 ids per request
+        batches = [release_ids[i:i + self.ALBUM_BATCH_SIZE] for i in range(0, len(release_ids), self.ALBUM_BATCH_SIZE)]
+        pages = []
+        for batch, results in zip(batches, self.scheduler.map(self.sp.albums, [(batch,) for batch in batches])):
+            for release_id, album in zip(batch, results["albums"]):
+                if album:
+                    release_tracks[release_id]["items"].extend(album["tracks"]["items"])
+                    if album["tracks"]["next"]:
+                        pages.append((release_id, album["tracks"]))
+
+        # Request the next page of every release that has more tracks together
+        while pages:
+            results = self.scheduler.map(self.sp.next, [(page,) for _, page in pages])
+            next_pages = []
+            for (release_id, _), page in zip(pages, results):
+                release_tracks[release_id]["items"].extend(page["items"])
+                if page["next"]:
+                    next_pages.append((release_id, page))
+            pages = next_pages
+
+        return release_tracks
+
+    # Obtain full artist objects for the given artist ids, skipping artists already obtained during this run
+    # and artists stored in the local database that haven't gone stale yet
+    @run_metrics.timed("resolve_artists")
+    def _resolve_artists(self, artist_ids):
+        needed_ids = [artist_id for artist_id in dict.fromkeys(artist_ids) if artist_id not in self.artist_cache]
+
+        self.artist_cache.update(sql_utils.get_cached_artists(self.conn, needed_ids,
+                                                              self.config.artist_cache_ttl_days))
+        needed_ids = [artist_id for artist_id in needed_ids if artist_id not in self.artist_cache]
+
+        # Several artists endpoint accepts up to 50 ids per request
+        batches = [(needed_ids[i:i + self.ARTIST_BATCH_SIZE],)
+                   for i in range(0, len(needed_ids), self.ARTIST_BATCH_SIZE)]
+        with run_metrics.stage("fetch_artists"):
+            for results in self.scheduler.map(self.sp.artists, batches):
+                for artist_full in results["artists"]:
+                    if artist_full:
+                        self.artist_cache[artist_full["id"]] = artist_full
+                        self.fetched_artists.append(artist_full)
+
+    # Read the new release feed of every configured market, requesting the next page of every market's feed together,
+    # until each feed has had new_release_number releases read (or ends, if it is 0) or known_release_stop releases in
+    # a row that were already collected (never, if it is 0); yields the releases that weren't collected before in
+    # chunks of chunk_size, each release only once however many feeds list it, and records the ids of the releases
+    # read from each market's feed in market_release_ids
+    def _new_release_chunks(self, chunk_size):
+        markets = list(self.config.markets) or [None]
+        release_limit = self.config.new_release_number
+
+        page_size = min(release_limit, self.NEW_RELEASES_PAGE_SIZE) if release_limit else self.NEW_RELEASES_PAGE_SIZE
+        with run_metrics.stage("new_releases"):
+            results = self.scheduler.map(self.sp.new_releases, [(market, page_size) for market in markets])
+        pages = {market: result["albums"] for market, result in zip(markets, results)}
+
+        feeds = {market: {"read_count": 0, "known_in_row": 0} for market in markets}
+        collected_ids = set()
+        chunk = []
+        while pages:
+            with run_metrics.stage("new_releases"):
+                seen_ids = sql_utils.get_seen_releases(self.conn, [item["id"] for page in pages.values()
+                                                                   for item in page["items"]])
+                next_markets = [market for market, page in pages.items()
+                                if self._read_page(feeds[market], page, seen_ids, collected_ids, chunk,
+                                                   self.market_release_ids.setdefault(market, []))
+                                and page["next"]]
+
+            while len(chunk) >= chunk_size:
+                yield chunk[:chunk_size]
+                chunk = chunk[chunk_size:]
+
+            with run_metrics.stage("new_releases"):
+                results = self.scheduler.map(self.sp.next, [(pages[market],) for market in next_markets])
+            pages = {market: result["albums"] for market, result in zip(next_markets, results)}
+
+        if chunk:
+            yield chunk
+
+    # Read a page of a market's new release feed, adding the releases that weren't collected before (by this run
+    # either) to new_items and the ids of every release read to release_ids, and returning whether the feed should be
+    # read any further
+    def _read_page(self, feed, page, seen_ids, collected_ids, new_items, release_ids):
+        release_limit = self.config.new_release_number
+        known_release_stop = self.config.known_release_stop
+
+        for item in page["items"]:
+            if release_limit and feed["read_count"] >= release_limit:
+                return False
+            feed["read_count"] += 1
+            release_ids.append(item["id"])
+
+            if item["id"] in seen_ids:
+                feed["known_in_row"] += 1
+                if known_release_stop and feed["known_in_row"] >= known_release_stop:
+                    return False
+                continue
+
+            feed["known_in_row"] = 0
+            if item["id"] not in collected_ids:
+                collected_ids.add(item["id"])
+                new_items.append(item)
+
+        return not release_limit or feed["read_count"] < release_limit
+
+    # Pair each chunk of releases with the tracks of its albums and singles, loading them in the background while
+    # earlier chunks are stored, with no more than collection_prefetch_chunks chunks loaded ahead
+    def _with_release_tracks(self, chunks):
+        prefetch_chunks = self.config.collection_prefetch_chunks
+        stage = run_metrics.child_stage("load_release_tracks")
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            pending = deque()
+            for chunk in chunks:
+                release_ids = [item["id"] for item in chunk if item["album_type"] in ("album", "single")]
+                pending.append((chunk, executor.submit(self._load_release_tracks, stage, release_ids)))
+
+                while len(pending) > prefetch_chunks:
+                    chunk, future = pending.popleft()
+                    with run_metrics.stage("load_release_tracks"):
+                        release_tracks = future.result()
+                    yield chunk, release_tracks
+
+            while pending:
+                chunk, future = pending.popleft()
+                with run_metrics.stage("load_release_tracks"):
+                    release_tracks = future.result()
+                yield chunk, release_tracks
+
+    # Collect data from API, parse it, and store it into a local database under the given collection date
+    # (today's date by default), returning the number of releases that weren't collected before; releases are
+    # collected and committed in chunks of collection_commit_releases, so that memory use doesn't grow with the
+    # number of releases and a failed run keeps every chunk committed before it failed
+    @run_metrics.timed("collect_data")
+    def collect_data(self, collection_date=None):
+
+        self.collection_date = collection_date or datetime.today().strftime("%Y-%m-%d")
+        self._reset_buffers()
+
+        collected_count = 0
+        chunks = self._new_release_chunks(self.config.collection_commit_releases)
+        for items, release_tracks in self._with_release_tracks(chunks):
+            self._collect_chunk(items, release_tracks)
+            collected_count += len(items)
+
+        # Releases read after the last new release were only recorded in market_release_ids
+        with self.conn:
+            self._store_release_markets()
+
+        return collected_count
+
+    # Parse and store a chunk of releases along with their tracks, looking up every artist of the chunk together
+    def _collect_chunk(self, items, release_tracks):
+
+        # Look up artists again for every chunk, so that artists kept from a previous chunk or run don't outlive
+        # the artist cache TTL and the number of artists held doesn't grow with the run
+        self.artist_cache = {}
+        self.fetched_artists = []
+
+        artist_ids = []
+        for item in items:
+            if item["album_type"] not in ("album", "single"):
+                continue
+            for track in release_tracks[item["id"]]["items"]:
+                artist_ids.extend(artist["id"] for artist in track["artists"])
+            if item["album_type"] == "album":
+                artist_ids.extend(artist["id"] for artist in item["artists"])
 
-        # Define dataframes to temporarily store data obtained from API
+        self._resolve_artists(artist_ids)
 
-        self.album_columns = ["AlbumID", "CollectionDate", "Name", "ReleaseDate", "ImageURL"]
-        self.albums_df = pd.DataFrame(columns=self.album_columns).set_index("AlbumID")
+        self._parse_releases(items, release_tracks)
 
-        self.artist_columns = ["ArtistID", "Name", "Popularity"]
-        self.artists_df = pd.DataFrame(columns=self.artist_columns).set_index("ArtistID")
+        self._store_data([item["id"] for item in items])
 
-        self.artist_genre_columns = ["ArtistID", "Genre"]
-        self.artists_genre_df = pd.DataFrame(columns=self.artist_genre_columns)
+        self._reset_buffers()
 
-        self.album_artist_columns = ["AlbumID", "ArtistID"]
-        self.album_artist_df = pd.DataFrame(columns=self.album_artist_columns)
+    # Record the markets whose feed listed the releases read so far, then forget them; availability is only known
+    # for the markets that were asked for
+    def _store_release_markets(self):
+        sql_utils.mark_release_markets(self.conn, {market: release_ids for market, release_ids
+                                                   in self.market_release_ids.items() if market},
+                                       self.collection_date)
+        self.market_release_ids = {}
 
-        self.track_columns = ["TrackID", "SingleCollectionDate", "Name", "PreviewURL", "SingleTrackNumber",
-                              "SingleReleaseDate", "SingleImageURL"]
-        self.tracks_df = pd.DataFrame(columns=self.track_columns).set_index("TrackID")
+    # Write all data collected during this run into local database in a single transaction
+    @run_metrics.timed("store_data")
+    def _store_data(self, release_ids):
+        with self.conn:
 
-        self.track_artist_columns = ["TrackID", "ArtistID"]
-        self.track_artist_df = pd.DataFrame(columns=self.track_artist_columns)
+            # Insert only the new data from row buffers into local database
 
-        self.album_track_columns = ["AlbumID", "TrackID", "TrackNumber"]
-        self.album_track_df = pd.DataFrame(columns=self.album_track_columns)
+            self._insert_albums()
 
-    def __del__(self):
-        self.conn.close()
+            self._insert_artists()
 
-    # Insert new albums into local database
-    def _insert_albums(self):
-        albums_sql_df = pd.read_sql("SELECT AlbumID FROM Albums", self.conn).set_index("AlbumID")
-        compare_df = self.albums_df.join(albums_sql_df, how="inner")
-        self.albums_df = pd.concat([self.albums_df, compare_df]).drop_duplicates(keep=False)
-        self.albums_df.to_sql("Albums", self.conn, if_exists="append")
+            # Update artists that were fetched again because their stored details went stale
+            with run_metrics.stage("refresh_artists"):
+                sql_utils.refresh_artists(self.conn, self.fetched_artists)
 
-    # Insert new artists into local database
-    def _insert_artists(self):
-        self.artists_df = self.artists_df.drop_duplicates()
-        artists_sql_df = pd.read_sql("SELECT ArtistID FROM Artists", self.conn).set_index("ArtistID")
-        compare_df = self.artists_df.join(artists_sql_df, how="inner")
-        self.artists_df = pd.concat([self.artists_df, compare_df]).drop_duplicates(keep=False)
-        self.artists_df.to_sql("Artists", self.conn, if_exists="append")
+            self._insert_artist_genre()
 
-    # Insert genres related to new artists into local database
-    def _insert_artist_genre(self):
-        self.artists_genre_df = self.artists_genre_df.drop_duplicates()
-        artists_genre_sql_df = pd.read_sql("SELECT ArtistID, Genre FROM Artist_Genre", self.conn)
-        compare_df = self.artists_genre_df.merge(artists_genre_sql_df, on=["ArtistID", "Genre"])
-        self.artists_genre_df = pd.concat([self.artists_genre_df, compare_df]).drop_duplicates(keep=False).set_index([
-            "ArtistID",
-            "Genre"
-        ])
-        self.artists_genre_df.to_sql("Artist_Genre", self.conn, if_exists="append")
+            self._insert_album_artist()
 
-    # Insert album to artist relationships into local database
-    def _insert_album_artist(self):
-        album_artist_sql_df = pd.read_sql("SELECT AlbumID, ArtistID FROM Album_Artist", self.conn)
-        compare_df = self.album_artist_df.merge(album_artist_sql_df, on=["AlbumID", "ArtistID"])
-        self.album_artist_df = pd.concat([self.album_artist_df, compare_df]).drop_duplicates(keep=False).set_index([
-            "AlbumID",
-            "ArtistID"
-        ])
-        self.album_artist_df.to_sql("Album_Artist", self.conn, if_exists="append")
-
-    # Insert new tracks into local database
-    def _insert_tracks(self):
-        tracks_sql_df = pd.read_sql("SELECT TrackID FROM Tracks", self.conn).set_index("TrackID")
-        compare_df = self.tracks_df.join(tracks_sql_df, how="inner")
-        self.tracks_df = pd.concat([self.tracks_df, compare_df]).drop_duplicates(keep=False)
-        self.tracks_df.to_sql("Tracks", self.conn, if_exists="append")
+            self._insert_tracks()
 
-    # Insert track to artist relationships into local database
-    def _insert_track_artist(self):
-        track_artist_sql_df = pd.read_sql("SELECT TrackID, ArtistID FROM Track_Artist", self.conn)
-        compare_df = self.track_artist_df.merge(track_artist_sql_df, on=["TrackID", "ArtistID"])
-        self.track_artist_df = pd.concat([self.track_artist_df, compare_df]).drop_duplicates(keep=False).set_index([
-            "TrackID",
-            "ArtistID"
-        ])
-        self.track_artist_df.to_sql("Track_Artist", self.conn, if_exists="append")
+            self._insert_track_artist()
 
-    # Insert album to track relationships into local database
-    def _insert_album_track(self):
-        album_track_sql_df = pd.read_sql("SELECT AlbumID, TrackID FROM Album_Track", self.conn)
-        compare_df = self.album_track_df.merge(album_track_sql_df, on=["AlbumID", "TrackID"])
-        self.album_track_df = pd.concat([self.album_track_df, compare_df]).drop_duplicates(keep=False).set_index([
-            "AlbumID",
-            "TrackID"
-        ])
-        self.album_track_df.to_sql("Album_Track", self.conn, if_exists="append")
+            self._insert_album_track()
+
+            self._refresh_release_digest()
+
+            sql_utils.mark_releases_seen(self.conn, release_ids, self.collection_date)
+
+            self._store_release_markets()
 
-    # Collect data from API, parse it, and store it into a local database
-    def collect_data(self):
+    # Rebuild the digest rows of the releases in the row buffers, along with the releases collected under the same
+    # date whose stored artists were just refreshed; digests of earlier dates keep the artist details they were sent
+    # with
+    @run_metrics.timed("refresh_release_digest")
+    def _refresh_release_digest(self):
+        album_ids = {row[0] for row in self.album_rows}
+        track_ids = {row[0] for row in self.track_rows if row[1] is not None}
 
-        # Collects a number of new releases specified in the config.json file
-        results = self.sp.new_releases(limit=self.config["new_release_number"])
+        refreshed_artist_ids = [artist["id"] for artist in self.fetched_artists
+                                if artist["id"] not in self.new_artist_ids]
+        if refreshed_artist_ids:
+            refreshed_album_ids, refreshed_track_ids = sql_utils.get_releases_of_artists(
+                self.conn, refreshed_artist_ids, self.collection_date)
+            album_ids.update(refreshed_album_ids)
+            track_ids.update(refreshed_track_ids)
 
-        for item in results["albums"]["items"]:
+        sql_utils.refresh_release_digest(self.conn, album_ids, track_ids)
+
+    # Parse releases obtained from API, along with their tracks and artists, into the row buffers
+    @run_metrics.timed("parse_releases")
+    def _parse_releases(self, items, release_tracks):
+
+        for item in items:
 
             # Collect data for albums
             if item["album_type"] == "album":
 
                 album_id = item["id"]
-                collection_date = datetime.today().strftime("%Y-%m-%d")
+                collection_date = self.collection_date
                 album_name = item["name"]
                 release_date = item["release_date"]
                 image_url = item["images"][0]["url"]
-                row = pd.DataFrame([[album_id, collection_date, album_name, release_date, image_url]],
-                                   columns=self.album_columns).set_index("AlbumID")
-                self.albums_df = self.albums_df.append(row)
+                self.album_rows.append((album_id, collection_date, album_name, release_date, image_url))
 
-                album_tracks = self.sp.album_tracks(album_id)
+                album_tracks = release_tracks[album_id]
 
                 # Collect data for tracks of album
                 for track in album_tracks["items"]:
@@ -161,108 +398,68 @@ class APIClient:
                     track_name = track["name"]
                     track_number = track["track_number"]
                     track_preview = track["preview_url"]
-                    row = pd.DataFrame([[track_id, None, track_name, track_preview, None, None, None]],
-                                       columns=self.track_columns).set_index("TrackID")
-                    self.tracks_df = self.tracks_df.append(row)
+                    self.track_rows.append((track_id, None, track_name, track_preview, None, None, None))
 
-                    row = pd.DataFrame([[album_id, track_id, track_number]],
-                                       columns=self.album_track_columns)
-                    self.album_track_df = self.album_track_df.append(row)
+                    self.album_track_rows.append((album_id, track_id, track_number))
 
                     # Collect data for artists of tracks
                     for artist in track["artists"]:
                         artist_id = artist["id"]
                         artist_name = artist["name"]
-                        artist_full = self.sp.artist(artist_id)
+                        artist_full = self.artist_cache[artist_id]
                         artist_popularity = artist_full["popularity"]
 
-                        row = pd.DataFrame([[artist_id, artist_name, artist_popularity]],
-                                           columns=self.artist_columns).set_index("ArtistID")
-                        self.artists_df = self.artists_df.append(row)
+                        self.artist_rows.append((artist_id, artist_name, artist_popularity))
 
-                        row = pd.DataFrame([[track_id, artist_id]],
-                                           columns=self.track_artist_columns)
-                        self.track_artist_df = self.track_artist_df.append(row)
+                        self.track_artist_rows.append((track_id, artist_id))
 
                         # Collect data for genres of artists
                         for genre in artist_full["genres"]:
-                            row = pd.DataFrame([[artist_id, genre]],
-                                               columns=self.artist_genre_columns)
-                            self.artists_genre_df = self.artists_genre_df.append(row)
+                            self.artist_genre_rows.append((artist_id, genre))
 
                 # Collect data for artists of album
                 for artist in item["artists"]:
 
                     artist_id = artist["id"]
                     artist_name = artist["name"]
-                    artist_full = self.sp.artist(artist_id)
+                    artist_full = self.artist_cache[artist_id]
                     artist_popularity = artist_full["popularity"]
 
-                    row = pd.DataFrame([[artist_id, artist_name, artist_popularity]],
-                                       columns=self.artist_columns).set_index("ArtistID")
-                    self.artists_df = self.artists_df.append(row)
+                    self.artist_rows.append((artist_id, artist_name, artist_popularity))
 
-                    row = pd.DataFrame([[album_id, artist_id]],
-                                       columns=self.album_artist_columns)
-                    self.album_artist_df = self.album_artist_df.append(row)
+                    self.album_artist_rows.append((album_id, artist_id))
 
                     # Collect data for genres of artists
                     for genre in artist_full["genres"]:
-                        row = pd.DataFrame([[artist_id, genre]],
-                                           columns=self.artist_genre_columns)
-                        self.artists_genre_df = self.artists_genre_df.append(row)
+                        self.artist_genre_rows.append((artist_id, genre))
 
             # Collect data for singles
             elif item["album_type"] == "single":
-                tracks = self.sp.album_tracks(item["id"])
+                tracks = release_tracks[item["id"]]
 
                 track_image = item["images"][0]["url"]
                 track_release_date = item["release_date"]
 
                 for track in tracks["items"]:
                     track_id = track["id"]
-                    collection_date = datetime.today().strftime("%Y-%m-%d")
+                    collection_date = self.collection_date
                     track_name = track["name"]
                     track_number = track["track_number"]
                     track_preview = track["preview_url"]
-                    row = pd.DataFrame([[track_id, collection_date, track_name, track_preview,
-                                         track_number, track_release_date, track_image]],
-                                       columns=self.track_columns).set_index("TrackID")
-                    self.tracks_df = self.tracks_df.append(row)
+                    self.track_rows.append((track_id, collection_date, track_name, track_preview,
+                                            track_number, track_release_date, track_image))
 
                     # Collect data for artists of single
                     for artist in track["artists"]:
                         artist_id = artist["id"]
                         artist_name = artist["name"]
-                        artist_full = self.sp.artist(artist_id)
+                        artist_full = self.artist_cache[artist_id]
                         artist_popularity = artist_full["popularity"]
 
-                        row = pd.DataFrame([[artist_id, artist_name, artist_popularity]],
-                                           columns=self.artist_columns).set_index("ArtistID")
-                        self.artists_df = self.artists_df.append(row)
+                        self.artist_rows.append((artist_id, artist_name, artist_popularity))
 
-                        row = pd.DataFrame([[track_id, artist_id]],
-                                           columns=self.track_artist_columns)
-                        self.track_artist_df = self.track_artist_df.append(row)
+                        self.track_artist_rows.append((track_id, artist_id))
 
                         # Collect data for genres of artists
                         for genre in artist_full["genres"]:
-                            row = pd.DataFrame([[artist_id, genre]],
-                                               columns=self.artist_genre_columns)
-                            self.artists_genre_df = self.artists_genre_df.append(row)
-
-        # Insert only the new data from dataframes into local database
-
-        self._insert_albums()
-
-        self._insert_artists()
-
-        self._insert_artist_genre()
-
-        self._insert_album_artist()
-
-        self._insert_tracks()
-
-        self._insert_track_artist()
-
-        self._insert_album_track()
+                            self.artist_genre_rows.append((artist_id, genre))
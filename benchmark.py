@@ -0,0 +1,414 @@
+from api_client import APIClient
+
+from email_notifier import EmailNotifier
+
+import smtp_delivery
+
+import sql_utils
+
+import pandas as pd
+
+from request_scheduler import RequestScheduler
+
+from datetime import datetime, timedelta
+
+from email.mime.text import MIMEText
+
+from types import SimpleNamespace
+
+from urllib.parse import parse_qs, urlparse
+
+import argparse
+
+import json
+
+import socket
+
+import sqlite3
+
+import subprocess
+
+import sys
+
+import threading
+
+import time
+
+import tracemalloc
+
+
+# FakeSpotify stands in for spotipy.Spotify, serving deterministic new release, album track and artist payloads
+# for release_count releases of album_size tracks each, after waiting latency seconds per request
+class FakeSpotify:
+
+    def __init__(self, release_count, latency=0.0, prefix="", album_size=10, artists_per_track=2, artist_count=500):
+        self.release_count = release_count
+        self.latency = latency
+        self.prefix = prefix
+        self.album_size = album_size
+        self.artists_per_track = artists_per_track
+        self.artist_count = artist_count
+        self.call_counts = {}
+        self.lock = threading.Lock()
+
+    # Count a request to the given endpoint and wait for its simulated round trip
+    def _request(self, endpoint):
+        with self.lock:
+            self.call_counts[endpoint] = self.call_counts.get(endpoint, 0) + 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _artist(self, artist_number):
+        artist_number %= self.artist_count
+        return {"id": "artist" + str(artist_number), "name": "Artist " + str(artist_number),
+                "popularity": artist_number % 100, "genres": ["genre" + str(artist_number % 40)]}
+
+    def _item(self, album_number):
+        album_id = self.prefix + "album" + str(album_number)
+        artist = self._artist(album_number)
+        return {"id": album_id, "album_type": "album" if album_number % 2 else "single",
+                "name": "Album " + self.prefix + str(album_number), "release_date": "2020-01-01",
+                "images": [{"url": "https://i.scdn.co/image/" + album_id}],
+                "artists": [{"id": artist["id"], "name": artist["name"]}]}
+
+    def _tracks(self, album_number):
+        album_id = self.prefix + "album" + str(album_number)
+        tracks = []
+        for track_number in range(1, self.album_size + 1):
+            track_artists = [self._artist(album_number + n) for n in range(self.artists_per_track)]
+            tracks.append({"id": album_id + "track" + str(track_number),
+                           "name": "Track " + self.prefix + str(album_number) + "-" + str(track_number),
+                           "track_number": track_number, "preview_url": None,
+                           "artists": [{"id": artist["id"], "name": artist["name"]} for artist in track_artists]})
+        return tracks
+
+    def _new_releases_page(self, limit, offset):
+        end = min(offset + limit, self.release_count)
+        next_url = None
+        if end < self.release_count:
+            next_url = "fake://browse/new-releases?offset=" + str(end) + "&limit=" + str(limit)
+        return {"albums": {"items": [self._item(number) for number in range(offset, end)], "limit": limit,
+                           "offset": offset, "next": next_url, "total": self.release_count}}
+
+    def new_releases(self, country=None, limit=20, offset=0):
+        self._request("new_releases")
+        return self._new_releases_page(limit, offset)
+
+    def _tracks_page(self, album_id, limit, offset):
+        tracks = self._tracks(int(album_id[len(self.prefix + "album"):]))
+        end = min(offset + limit, len(tracks))
+        next_url = None
+        if end < len(tracks):
+            next_url = "fake://albums/" + album_id + "/tracks?offset=" + str(end) + "&limit=" + str(limit)
+        return {"items": tracks[offset:end], "limit": limit, "offset": offset, "next": next_url, "total": len(tracks)}
+
+    def next(self, result):
+        self._request("next")
+        url = urlparse(result["next"])
+        query = parse_qs(url.query)
+        limit = int(query["limit"][0])
+        offset = int(query["offset"][0])
+        if url.netloc == "browse":
+            return self._new_releases_page(limit, offset)
+        return self._tracks_page(url.path.split("/")[1], limit, offset)
+
+    def album_tracks(self, album_id, limit=50, offset=0, market=None):
+        self._request("album_tracks")
+        return self._tracks_page(album_id, limit, offset)
+
+    def albums(self, albums, market=None):
+        self._request("albums")
+        return {"albums": [dict(self._item(int(album_id[len(self.prefix + "album"):])),
+                                tracks=self._tracks_page(album_id, 50, 0)) for album_id in albums]}
+
+    def artists(self, artists):
+        self._request("artists")
+        return {"artists": [self._artist(int(artist_id[len("artist"):])) for artist_id in artists]}
+
+
+# Build a synthetic new release feed with the given number of tracks, split into albums of album_size tracks
+def synthetic_releases(track_count, album_size=10):
+    fake = FakeSpotify(track_count // album_size, album_size=album_size)
+    items = [fake._item(number) for number in range(fake.release_count)]
+    release_tracks = {item["id"]: {"items": fake._tracks(number)} for number, item in enumerate(items)}
+    artists = {"artist" + str(number): fake._artist(number) for number in range(fake.artist_count)}
+    return items, release_tracks, artists
+
+
+# Create an APIClient that only parses and stores data, without a token and with an in-memory database
+def offline_client(artists):
+    client = APIClient.__new__(APIClient)
+    client.conn = sqlite3.connect(":memory:")
+    sql_utils.tune_connection(client.conn)
+    sql_utils.create_release_tables(client.conn)
+    client.artist_cache = artists
+    client.fetched_artists = []
+    client.collection_date = datetime.today().strftime("%Y-%m-%d")
+    client._reset_buffers()
+    return client
+
+
+# Create an APIClient that collects from the given fake Spotify client into the given database connection
+def fake_client(conn, sp, release_count, workers):
+    client = APIClient.__new__(APIClient)
+    client.config = SimpleNamespace(new_release_number=release_count, known_release_stop=0, artist_cache_ttl_days=7,
+                                    markets=(), collection_commit_releases=100, collection_prefetch_chunks=1)
+    client.conn = conn
+    client.sp = sp
+    client.scheduler = RequestScheduler(workers, 1000000, 0)
+    client.artist_cache = {}
+    client.fetched_artists = []
+    client._reset_buffers()
+    return client
+
+
+# Fill the given database connection with days of history, history_releases releases collected on each day
+def generate_history(conn, days, history_releases):
+    for day in range(days, 0, -1):
+        collection_date = (datetime.today() - timedelta(days=day)).strftime("%Y-%m-%d")
+        sp = FakeSpotify(history_releases, prefix="day" + str(day) + "-")
+        fake_client(conn, sp, history_releases, 1).collect_data(collection_date)
+
+
+# Run func, returning its result along with its wall time in seconds and the peak memory it allocated in MB
+def measure(func, *args):
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = func(*args)
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, {"seconds": round(elapsed, 4), "peak_memory_mb": round(peak / 1000000, 2)}
+
+
+# Measure each stage of a run collecting release_count releases into a database with days of history
+def bench_stages(release_count, days, history_releases, latency, workers):
+    conn = sqlite3.connect(":memory:")
+    sql_utils.tune_connection(conn)
+    sql_utils.create_release_tables(conn)
+
+    results = {}
+    _, results["generate_history"] = measure(generate_history, conn, days, history_releases)
+
+    sp = FakeSpotify(release_count, latency=latency, prefix="today-")
+    client = fake_client(conn, sp, release_count, workers)
+
+    # Releases are stored in chunks as they are collected, so storing is measured as part of collect_data
+    _, results["collect_data"] = measure(client.collect_data)
+    results["collect_data"]["api_calls"] = dict(sp.call_counts)
+
+    notifier = offline_notifier(conn)
+    _, results["get_data_to_send"] = measure(notifier.get_data_to_send)
+    _, results["construct_email"] = measure(notifier._construct_email)
+
+    conn.close()
+    return results
+
+
+# Print the stage measurements of each size, along with their ratio to the baseline measurements if there are any
+def report_stages(suite, baseline):
+    for size, stages in suite.items():
+        print("Stages for " + size + " releases:")
+        for stage, result in stages.items():
+            line = "  {:<18} {:>9.4f} s {:>9.2f} MB".format(stage, result["seconds"], result["peak_memory_mb"])
+            baseline_result = baseline.get(size, {}).get(stage)
+            if baseline_result:
+                line += "  ({:.2f}x time, {:.2f}x memory of baseline)".format(
+                    result["seconds"] / max(baseline_result["seconds"], 0.0001),
+                    result["peak_memory_mb"] / max(baseline_result["peak_memory_mb"], 0.01))
+            if "api_calls" in result:
+                line += "  API calls: " + json.dumps(result["api_calls"], sort_keys=True)
+            print(line)
+
+
+# Create an offline APIClient whose database holds release_count releases collected today
+def synthetic_release_db(release_count):
+    items, release_tracks, artists = synthetic_releases(release_count * 10)
+    client = offline_client(artists)
+    client._parse_releases(items, release_tracks)
+    client._store_data([item["id"] for item in items])
+    return client
+
+
+# Accumulate the rows one single-row dataframe at a time, as collect_data used to with DataFrame.append
+def per_row_accumulation(client):
+    tables = [(client.album_rows, client.album_columns), (client.artist_rows, client.artist_columns),
+              (client.artist_genre_rows, client.artist_genre_columns),
+              (client.album_artist_rows, client.album_artist_columns), (client.track_rows, client.track_columns),
+              (client.track_artist_rows, client.track_artist_columns),
+              (client.album_track_rows, client.album_track_columns)]
+    for rows, columns in tables:
+        df = pd.DataFrame(columns=columns)
+        for row in rows:
+            df = pd.concat([df, pd.DataFrame([row], columns=columns)])
+
+
+# Time parsing a synthetic run of track_count tracks into insert batches
+def bench_collect(track_count, compare):
+    items, release_tracks, artists = synthetic_releases(track_count)
+    client = offline_client(artists)
+
+    start = time.perf_counter()
+    client._parse_releases(items, release_tracks)
+    buffered = time.perf_counter() - start
+    print("collect_data parsing, " + str(track_count) + " tracks, row buffers: " +
+          "{:.3f}".format(buffered) + " s")
+
+    if compare:
+        start = time.perf_counter()
+        per_row_accumulation(client)
+        per_row = time.perf_counter() - start
+        print("collect_data parsing, " + str(track_count) + " tracks, per-row append: " +
+              "{:.3f}".format(per_row) + " s (" + "{:.0f}".format(per_row / buffered) + "x slower)")
+
+
+# Create an EmailNotifier that reads from the given connection, without recipients or an SMTP server
+def offline_notifier(conn):
+    notifier = EmailNotifier.__new__(EmailNotifier)
+    notifier.conn = conn
+    notifier.new_albums = True
+    notifier.new_singles = True
+    notifier.album_fragments = None
+    notifier.preferences = {}
+    return notifier
+
+
+# Time rendering the email for a digest of release_count releases, in full and personalised for each recipient
+def bench_render(release_count, recipient_count):
+    client = synthetic_release_db(release_count)
+    notifier = offline_notifier(client.conn)
+    notifier.get_data_to_send()
+
+    start = time.perf_counter()
+    notifier._construct_email()
+    elapsed = time.perf_counter() - start
+    print("_construct_email, " + str(release_count) + " releases: " + "{:.3f}".format(elapsed) + " s (" +
+          str(len(notifier.html)) + " characters)")
+
+    # Assemble a personalised digest for recipients interested in 3 genres each
+    genres = list(notifier.genre_index)
+    notifier.preferences = {"recipient" + str(number) + "@example.com": {
+        "genres": {genres[(number + offset) % len(genres)] for offset in range(3)}, "artist_ids": set()}
+        for number in range(recipient_count)}
+
+    start = time.perf_counter()
+    for email_address in notifier.preferences:
+        notifier._construct_email(notifier._releases_for(email_address))
+    elapsed = time.perf_counter() - start
+    print("_construct_email, " + str(recipient_count) + " personalised digests of " + str(release_count) +
+          " releases: " + "{:.3f}".format(elapsed) + " s")
+
+
+# Time searches of a release database holding release_count releases of 10 tracks each, as the search CLI runs them
+def bench_search(release_count):
+    client = synthetic_release_db(release_count)
+    indexed_count = client.conn.execute("SELECT COUNT(*) FROM Release_Search").fetchone()[0]
+    searches = [("Album 7", None, 1), ("Artist 42", "Artists", 1), ("genre3", "Genres", 1), ("Track", "Tracks", 1),
+                ("Track", None, 50)]
+
+    for text, column, page in searches:
+        start = time.perf_counter()
+        results = sql_utils.search_releases(client.conn, text, column, page)
+        elapsed = time.perf_counter() - start
+        print("search_releases, " + str(indexed_count) + " indexed releases, " + repr(text) + " in " +
+              str(column or "every column") + ", page " + str(page) + ": " + "{:.1f}".format(elapsed * 1000) +
+              " ms (" + str(len(results)) + " results)")
+
+
+# Time delivering message_count messages through the delivery engine to a local SMTP server (requires aiosmtpd)
+def bench_delivery(message_count, connections):
+    from aiosmtpd.controller import Controller
+    from aiosmtpd.handlers import Sink
+
+    with socket.socket() as free_socket:
+        free_socket.bind(("127.0.0.1", 0))
+        port = free_socket.getsockname()[1]
+
+    controller = Controller(Sink(), hostname="127.0.0.1", port=port)
+    controller.start()
+    try:
+        pool = smtp_delivery.SMTPConnectionPool("127.0.0.1", port, "sender@example.com", None, connections,
+                                                use_ssl=False)
+        engine = smtp_delivery.DeliveryEngine(pool, message_count)
+        message = MIMEText("<h3>New release</h3>" * 2500, "html", "utf-8").as_string()
+        messages = [(["recipient" + str(number) + "@example.com"], message) for number in range(message_count)]
+
+        start = time.perf_counter()
+        engine.send("sender@example.com", messages)
+        elapsed = time.perf_counter() - start
+        pool.close()
+    finally:
+        controller.stop()
+
+    print("DeliveryEngine, " + str(message_count) + " messages over " + str(connections) + " connections: " +
+          "{:.0f}".format(message_count / elapsed) + " messages/s")
+
+
+# Import the given module in a fresh interpreter with -X importtime, returning the cumulative import time in
+# microseconds of every module it loaded, keyed by module name
+def import_times(module):
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import " + module],
+                            capture_output=True, text=True, check=True)
+    times = {}
+    for line in result.stderr.splitlines():
+        fields = line[len("import time:"):].split("|")
+        if line.startswith("import time:") and len(fields) == 3 and fields[1].strip().isdigit():
+            times[fields[2].strip()] = int(fields[1])
+    return times
+
+
+# Time importing main, which a run without anything new to send is limited to, along with the modules of each step
+# of a run, and check that main doesn't load pandas or spotipy itself
+def bench_import_time():
+    main_times = import_times("main")
+    for heavy_module in ("pandas", "spotipy"):
+        if heavy_module in main_times:
+            raise Exception("Importing main loads " + heavy_module)
+
+    print("import main: " + "{:.1f}".format(main_times["main"] / 1000) + " ms")
+    for module in ("api_client", "email_notifier", "outbox"):
+        print("import " + module + ": " + "{:.1f}".format(import_times(module)[module] / 1000) + " ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the Spotify New Release Notifier offline")
+    parser.add_argument("--tracks", type=int, default=10000, help="number of synthetic tracks to collect")
+    parser.add_argument("--compare", action="store_true", help="also time the old per-row accumulation")
+    parser.add_argument("--releases", type=int, default=500, help="number of synthetic releases to render")
+    parser.add_argument("--recipients", type=int, default=1000, help="number of personalised digests to assemble")
+    parser.add_argument("--search-releases", type=int, default=1000,
+                        help="number of synthetic releases to search through")
+    parser.add_argument("--messages", type=int, default=0,
+                        help="number of messages to deliver to a local SMTP server (requires aiosmtpd)")
+    parser.add_argument("--sizes", default="10,1000",
+                        help="comma separated numbers of releases to measure every stage of a run with")
+    parser.add_argument("--history-days", type=int, default=30, help="days of history in the release database")
+    parser.add_argument("--history-releases", type=int, default=100, help="releases collected per day of history")
+    parser.add_argument("--latency", type=float, default=0.0, help="simulated seconds per Spotify API request")
+    parser.add_argument("--workers", type=int, default=8, help="concurrent Spotify API requests")
+    parser.add_argument("--baseline", help="JSON file of stage measurements to compare against")
+    parser.add_argument("--save-baseline", help="JSON file to save the stage measurements of this run to")
+    args = parser.parse_args()
+
+    bench_import_time()
+    suite = {size: bench_stages(int(size), args.history_days, args.history_releases, args.latency, args.workers)
+             for size in args.sizes.split(",")}
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+    report_stages(suite, baseline)
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as baseline_file:
+            json.dump(suite, baseline_file, indent=2)
+
+    bench_collect(args.tracks, args.compare)
+    bench_render(args.releases, args.recipients)
+    bench_search(args.search_releases)
+    if args.messages:
+        bench_delivery(args.messages, 1)
+        bench_delivery(args.messages, 4)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,3 @@
+call <Enter-path-to-miniconda-or-anaconda>\Scripts\activate.bat <Enter-path-to-miniconda-or-anaconda>
+call conda activate Spotify-New-Release-Notifier
+call python daemon.py
\ No newline at end of file
@@ -0,0 +1,128 @@
+import main
+
+from metrics import run_metrics
+
+import settings
+
+import sql_utils
+
+from datetime import datetime, timedelta
+
+import signal
+
+import threading
+
+
+# Daemon keeps running between runs, collecting new releases on an interval and sending a daily digest of them,
+# while the connections to the local databases and the Spotify client, with its HTTP session and caches, stay warm
+class Daemon:
+
+    def __init__(self, config):
+        self.config = config
+        self.collection_interval = timedelta(minutes=config.daemon_collection_interval_minutes)
+        self.notification_time = datetime.strptime(config.daemon_notification_time, "%H:%M").time()
+        self.stop_event = threading.Event()
+        self.session = None
+        self.spotify_client = None
+
+    # Ask the daemon to stop once the run in progress (if any) is over
+    def stop(self, signal_number=None, frame=None):
+        print("Stopping once the current run is over")
+        self.stop_event.set()
+
+    # Get the first time of the daily digest after the given time
+    def _next_notification(self, now):
+        notification = datetime.combine(now.date(), self.notification_time)
+        if notification <= now:
+            notification += timedelta(days=1)
+        return notification
+
+    # Get the next time a run scheduled every interval since scheduled should start at, skipping the runs that were
+    # due while the previous run was still going
+    def _next_run(self, name, scheduled, interval):
+        now = datetime.now()
+        skipped_count = 0
+        scheduled += interval
+        while scheduled <= now:
+            scheduled += interval
+            skipped_count += 1
+        if skipped_count:
+            print("Skipped " + str(skipped_count) + " " + name + " runs while the previous run was still going")
+        return scheduled
+
+    # Run collection and notification on their schedules until the daemon is stopped
+    def run(self):
+        with sql_utils.DatabaseSession(self.config) as session:
+            self.session = session
+
+            next_collection = datetime.now()
+            next_notification = self._next_notification(next_collection)
+            while not self.stop_event.is_set():
+                now = datetime.now()
+                if now >= next_notification:
+                    self._run("notification", self._notify, next_notification.strftime("%Y-%m-%d"))
+                    next_notification = self._next_run("notification", next_notification, timedelta(days=1))
+                elif now >= next_collection:
+                    self._run("collection", self._collect)
+                    next_collection = self._next_run("collection", next_collection, self.collection_interval)
+                else:
+                    self.stop_event.wait((min(next_collection, next_notification) - now).total_seconds())
+
+        print("Daemon stopped")
+
+    # Run a job, writing the metrics of the run to a metrics report once it is over
+    def _run(self, name, job, *args):
+        run_metrics.reset()
+        try:
+            with run_metrics.stage(name):
+                job(*args)
+        except Exception as e:
+            print("Exception: " + str(e))
+        finally:
+            run_metrics.write_report(self.config.metrics_report_path)
+
+    # The Spotify client is created by the first run and kept afterwards, its token manager replacing its token
+    # whenever it is about to expire
+    def _get_spotify_client(self):
+        if self.spotify_client is None:
+            from api_client import APIClient
+
+            self.spotify_client = APIClient(self.config, self.session)
+        return self.spotify_client
+
+    # Collect new releases under the given date, returning the number collected; a client that can't be created
+    # (e.g. no token could be obtained) fails the collection only, so that queued emails are still delivered
+    def _collect_releases(self, collection_date):
+        try:
+            spotify_client = self._get_spotify_client()
+        except Exception as e:
+            print("Exception: " + str(e))
+            return 0
+        return main.collect_releases(self.config, self.session, spotify_client, collection_date)
+
+    # Collect new releases under the date of the next digest, so that every release collected between two digests
+    # is sent in the second one, and retry queued emails that couldn't be delivered yet
+    def _collect(self):
+        collection_date = self._next_notification(datetime.now()).strftime("%Y-%m-%d")
+        self._collect_releases(collection_date)
+        main.deliver_emails(self.config, self.session)
+
+    # Collect the newest releases one last time, then queue and deliver the digest of the given date
+    def _notify(self, collection_date):
+        collected_count = self._collect_releases(collection_date)
+        main.queue_notifications(self.config, self.session, collected_count, collection_date)
+        main.deliver_emails(self.config, self.session)
+
+
+def run_daemon():
+    daemon = Daemon(settings.load_config())
+
+    # Finish the run in progress before stopping on Ctrl+C or when the process is asked to terminate
+    signal.signal(signal.SIGINT, daemon.stop)
+    signal.signal(signal.SIGTERM, daemon.stop)
+
+    daemon.run()
+
+
+if __name__ == "__main__":
+    run_daemon()
@@ -2,308 +2,284 @@ import pandas as pd
 
 import sql_utils
 
+from metrics import run_metrics
+
+import smtp_delivery
+
 from datetime import datetime
 
-import smtplib
-import ssl
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 
+from html import escape
+
+import hashlib
+
 import json
 
+# Query for the digest of the releases collected on a given date, most popular first
 
-# EmailNotifier handles the sending of email notifications to recipients
-class EmailNotifier:
+DIGEST_QUERY = "SELECT ReleaseID, ReleaseType, Name, ReleaseDate, ImageURL, PreviewURL, ArtistIDs, Artists, " \
+               "Tracks, Genres " \
+               "FROM Release_Digest " \
+               "WHERE CollectionDate = ? " \
+               "ORDER BY Popularity DESC, ReleaseID"
 
-    PORT = 465
+# Templates of the parts that make up the html of the email
 
-    def __init__(self):
+EMAIL_HEADER = """\
+            <html>
+              <head>
+              </head>
+              <body>
+                <h1>New Releases on Spotify</h1>
+            """
 
-        # Connect to local database storing new release data
-        self.conn = sql_utils.create_sqlite_connection()
+EMAIL_FOOTER = """
+              </body>
+            </html>
+            """
 
-        # Connect to local configuration database
-        config_conn = sql_utils.create_config_connection()
+SECTION_TEMPLATE = "<h2 style='margin-bottom:25px;'><u>{title}</u></h2>"
 
-        # Obtain recipients from configuration database
-        self.recipients_df = pd.read_sql("SELECT EmailAddress, Name FROM Notification_Recipients", config_conn)
+ALBUM_HEADER_TEMPLATE = "<table style='margin-bottom:25px'><tr>" \
+                        "<td valign='top'><img src='{image_url}' style='width:300px;height:300px;'></td>" \
+                        "<td valign='top'><h2 style='line-height:15px;margin-left:40px;'>{name}</h2>" \
+                        "<h3 style='margin-left:40px;'>by {artists}</h3>"
 
-        self.html = None
-        self.new_albums = True
-        self.new_singles = True
-        self.albums_df = None
-        self.album_tracks_df = None
-        self.single_tracks_df = None
-
-        with open("config.json") as config_file:
-            config = json.load(config_file)
-
-        # Obtain info for the sender email from config.json
-        self.email = config["sender_email"]
-        self.password = config["sender_password"]
-        self.smtpserver = config["smtp_server"]
-
-    def __del__(self):
-        self.conn.close()
-
-    # Gets up-to-date data from local database storing new release data to send in email notification
-    def get_data_to_send(self):
-
-        # Store albums into a dataframe
-        self.albums_df = pd.read_sql("SELECT Albums.AlbumID AS AlbumID, Albums.Name AS Album_Name, ReleaseDate, " +
-                                     "ImageURL, Artists.ArtistID AS ArtistID, Artists.Name AS Artist_Name, " +
-                                     "Popularity " +
-                                     "FROM Albums " +
-                                     "INNER JOIN Album_Artist ON Albums.AlbumID = Album_Artist.AlbumID " +
-                                     "INNER JOIN Artists ON Album_Artist.ArtistID = Artists.ArtistID " +
-                                     "WHERE CollectionDate = '" +
-                                     datetime.today().strftime("%Y-%m-%d") + "' " +
-                                     "ORDER BY Popularity DESC", self.conn)
-
-        if self.albums_df.empty:
-            self.new_albums = False
-
-        # Store tracks in albums into a dataframe
-        self.album_tracks_df = pd.read_sql(
-            "SELECT Album_Track.AlbumID AS AlbumID, Album_Track.TrackID AS TrackID, " +
-            "Album_Track.TrackNumber AS TrackNumber, Tracks.Name AS Track_Name, PreviewURL, " +
-            "Artists.Name AS Artist_Name " +
-            "FROM Albums " +
-            "INNER JOIN Album_Track ON Albums.AlbumID = Album_Track.AlbumID " +
-            "INNER JOIN Tracks ON Album_Track.TrackID = Tracks.TrackID " +
-            "INNER JOIN Track_Artist ON Tracks.TrackID = Track_Artist.TrackID " +
-            "INNER JOIN Artists ON Track_Artist.ArtistID = Artists.ArtistID " +
-            "WHERE Albums.CollectionDate = '" +
-            datetime.today().strftime("%Y-%m-%d") + "'", self.conn)
-
-        # Store singles into a dataframe
-        self.single_tracks_df = pd.read_sql(
-            "SELECT Tracks.TrackID AS TrackID, Tracks.Name AS Track_Name, PreviewURL, SingleReleaseDate, " +
-            "SingleImageURL, Artists.ArtistID AS ArtistID, Artists.Name AS Artist_Name, Popularity " +
-            "FROM Tracks " +
-            "INNER JOIN Track_Artist ON Tracks.TrackID = Track_Artist.TrackID " +
-            "INNER JOIN Artists ON Artists.ArtistID = Track_Artist.ArtistID " +
-            "WHERE SingleCollectionDate = '" +
-            datetime.today().strftime("%Y-%m-%d") + "' " +
-            "ORDER BY Popularity DESC", self.conn)
-
-        if self.single_tracks_df.empty:
-            self.new_singles = False
+TRACK_TEMPLATE = "<h4 style='margin-left:80px;'>{number}. {name}{featured}</h4>"
 
-        if not self.new_albums and not self.new_singles:
-            return False
+SINGLE_TEMPLATE = "<table style='margin-bottom:25px'><tr>" \
+                  "<td valign='top'><img src='{image_url}' style='width:200px;height:200px;'></td>" \
+                  "<td valign='top'><h2 style='line-height:15px;margin-left:40px;'>{name}</h2>" \
+                  "<h3 style='margin-left:40px;'>by {artists}</h3>"
 
-        return True
+GENRES_TEMPLATE = "<h3 style='margin-left:40px;'>Genres: {genres}</h3>"
 
-    # Add new albums to html of email
-    def _add_albums(self):
-        encountered_albums = []
-        for index, row in self.albums_df.iterrows():
-
-            album_id = row["AlbumID"]
-            if album_id in encountered_albums:
-                continue
-
-            album_name = row["Album_Name"]
-            release_date = row["ReleaseDate"]
-            image_url = row["ImageURL"]
-            needed_albums = self.albums_df.loc[self.albums_df["AlbumID"] == album_id]
-            album_artists = []
-            album_artist_ids = []
-            for i, artist_row in needed_albums.iterrows():
-                album_artist_ids.append(artist_row["ArtistID"])
-                album_artists.append(artist_row["Artist_Name"])
-
-            self.html = self.html + "<table style='margin-bottom:25px'><tr>"
-
-            self.html = self.html + "<td valign='top'><img src=" + \
-                image_url + \
-                " style='width:300px;height:300px;'></td>"
-
-            self.html = self.html + "<td valign='top'><h2 style='line-height:15px;margin-left:40px;'>" + \
-                album_name + \
-                "</h2>"
-
-            # Add album artists to html of email
-            self.html = self.html + "<h3 style='margin-left:40px;'>by " + album_artists[0]
-            for i in range(1, len(album_artists)):
-                self.html = self.html + ", " + album_artists[i]
-            self.html = self.html + "</h3>"
-
-            tracks_in_album = self.album_tracks_df.loc[self.album_tracks_df["AlbumID"] == album_id]
-            tracks_in_album.sort_values(by=["TrackNumber"])
-
-            # Add album's tracks to html of email
-            encountered_tracks = []
-            for track_index, track_row in tracks_in_album.iterrows():
-                track_id = track_row["TrackID"]
-                if track_id in encountered_tracks:
-                    continue
-                track_name = track_row["Track_Name"]
-                track_number = track_row["TrackNumber"]
-                track_preview = track_row["PreviewURL"]
-                needed_tracks = tracks_in_album.loc[tracks_in_album["TrackID"] == track_id]
-                track_artists = []
-                for i, artist_row in needed_tracks.iterrows():
-                    track_artists.append(artist_row["Artist_Name"])
-
-                for artist in album_artists:
-                    track_artists.remove(artist)
-
-                self.html = self.html + "<h4 style='margin-left:80px;'>" + str(track_number) + ". "
-
-                if track_preview:
-                    self.html = self.html + "<a href='" + track_preview + "'>"
-
-                self.html = self.html + track_name
+RELEASE_FOOTER_TEMPLATE = "{genres}<h3 style='margin-left:40px;'>Released: {release_date}</h3></td></tr></table>"
 
-                if track_preview:
-                    self.html = self.html + "</a>"
-
-                if track_artists:
-                    self.html = self.html + " ft. " + track_artists[0]
-                    for i in range(1, len(track_artists)):
-                        self.html = self.html + ", " + track_artists[i]
-                self.html = self.html + "</h4>"
-
-                encountered_tracks.append(track_id)
-
-            # Add album genres to html of email
-            genres = []
-            for artist_id in album_artist_ids:
-                artist_genres = pd.read_sql("SELECT Genre FROM Artist_Genre WHERE ArtistID = '" + artist_id + "'",
-                                            self.conn)
-                for i, genre_row in artist_genres.iterrows():
-                    genres.append(genre_row["Genre"])
-
-            genres = list(dict.fromkeys(genres))
-
-            if genres:
-                self.html = self.html + "<h3 style='margin-left:40px;'>Genres: " + genres[0]
-                for i in range(1, len(genres)):
-                    self.html = self.html + ", " + genres[i]
-                self.html = self.html + "</h3>"
-
-            # Add album release date to html of email
-            self.html = self.html + "<h3 style='margin-left:40px;'>Released: " + release_date + "</h3></td>"
-
-            self.html = self.html + "</tr></table>"
-
-            encountered_albums.append(album_id)
-
-    # Add new singles to html of email
-    def _add_singles(self):
-        encountered_singles = []
-        for index, row in self.single_tracks_df.iterrows():
-
-            track_id = row["TrackID"]
-            if track_id in encountered_singles:
-                continue
-
-            track_name = row["Track_Name"]
-            track_preview = row["PreviewURL"]
-            track_release_date = row["SingleReleaseDate"]
-            track_image = row["SingleImageURL"]
-            needed_singles = self.single_tracks_df.loc[self.single_tracks_df["TrackID"] == track_id]
-            single_artists = []
-            single_artist_ids = []
-            for i, artist_row in needed_singles.iterrows():
-                single_artist_ids.append(artist_row["ArtistID"])
-                single_artists.append(artist_row["Artist_Name"])
+LINK_TEMPLATE = "<a href='{url}'>{text}</a>"
 
-            self.html = self.html + "<table style='margin-bottom:25px'><tr>"
 
-            self.html = self.html + "<td valign='top'><img src=" + track_image + \
-                " style='width:200px;height:200px;'></td>"
+# Escape the given names and join them into a comma separated list
+def _escape_list(names):
+    return ", ".join(escape(name) for name in names)
 
-            self.html = self.html + "<td valign='top'><h2 style='line-height:15px;margin-left:40px;'>"
 
-            if track_preview:
-                self.html = self.html + "<a href='" + track_preview + "'>"
-
-            self.html = self.html + track_name
+# Render the given text, linked to url if there is one
+def _render_link(text, url):
+    if url:
+        return LINK_TEMPLATE.format(url=escape(url), text=escape(text))
+    return escape(text)
 
-            if track_preview:
-                self.html = self.html + "</a>"
 
-            self.html = self.html + "</h2>"
+# Render the artists featured on a track
+def _render_featured(artists):
+    if artists:
+        return " ft. " + _escape_list(artists)
+    return ""
 
-            # Add single artists to html of email
-            self.html = self.html + "<h3 style='margin-left:40px;'>by " + single_artists[0]
-            for i in range(1, len(single_artists)):
-                self.html = self.html + ", " + single_artists[i]
-            self.html = self.html + "</h3>"
 
-            # Add genres of single to html of email
-            genres = []
-            for artist_id in single_artist_ids:
-                artist_genres = pd.read_sql("SELECT Genre FROM Artist_Genre WHERE ArtistID = '" + artist_id + "'",
-                                            self.conn)
-                for i, genre_row in artist_genres.iterrows():
-                    genres.append(genre_row["Genre"])
+# Render the genres of a release
+def _render_genres(genres):
+    if not genres:
+        return ""
+    return GENRES_TEMPLATE.format(genres=_escape_list(genres))
 
-            genres = list(dict.fromkeys(genres))
 
-            if genres:
-                self.html = self.html + "<h3 style='margin-left:40px;'>Genres: " + genres[0]
-                for i in range(1, len(genres)):
-                    self.html = self.html + ", " + genres[i]
-                self.html = self.html + "</h3>"
+# EmailNotifier handles the sending of email notifications to recipients
+class EmailNotifier:
 
-            # Add single release date to html of email
-            self.html = self.html + "<h3 style='margin-left:40px;'>Released: " + track_release_date + "</h3></td>"
+    def __init__(self, config, session):
 
-            self.html = self.html + "</tr></table>"
+        # Use the run's connection to local database storing new release data
+        self.conn = session.conn
 
-            encountered_singles.append(track_id)
+        # Obtain recipients and the genres and artists they are interested in from configuration database
+        self.recipients_df = pd.read_sql("SELECT EmailAddress, Name FROM Notification_Recipients",
+                                         session.config_conn)
+        self.preferences = sql_utils.get_recipient_preferences(session.config_conn)
 
-    # Construct html of email to send
-    def _construct_email(self):
-        self.html = """\
-            <html>
-              <head>
-              </head>
-              <body>
-                <h1>New Releases on Spotify</h1>
-            """
+        self.html = None
+        self.collection_date = None
+        self.new_albums = True
+        self.new_singles = True
+        self.albums = {}
+        self.singles = {}
+        self.album_fragments = None
+        self.single_fragments = None
+        self.genre_index = {}
+        self.artist_index = {}
+
+        # Obtain info for the sender email and the recipient limit of the SMTP server from config.json
+        self.email = config.sender_email
+        self.max_recipients = config.smtp_max_recipients
+
+    # Gets up-to-date data from local database storing new release data to send in email notification, for the
+    # releases collected on the given collection date (today's date by default)
+    @run_metrics.timed("get_data_to_send")
+    def get_data_to_send(self, collection_date=None):
+        self.collection_date = collection_date or datetime.today().strftime("%Y-%m-%d")
+
+        # Load the digest of every album and single collected on that date in one range scan
+        self._group_data(self.conn.execute(DIGEST_QUERY, (self.collection_date,)))
+
+        self.new_albums = bool(self.albums)
+        self.new_singles = bool(self.singles)
+        if not self.new_albums and not self.new_singles:
+            return False
 
-        # Construct albums part of email
-        if self.new_albums:
-            self.html = self.html + "<h2 style='margin-bottom:25px;'><u>Albums</u></h2>"
+        self._build_indexes()
+
+        return True
 
-        self._add_albums()
+    # Split the rows of the digest into albums and singles, keeping the order of the digest, so that the email can be
+    # rendered in a single pass
+    def _group_data(self, digest_rows):
+        self.albums = {}
+        self.singles = {}
+        for (release_id, release_type, name, release_date, image_url, preview_url, artist_ids, artists, tracks,
+             genres) in digest_rows:
+            release = {"name": name, "release_date": release_date, "image_url": image_url,
+                       "preview_url": preview_url, "artist_ids": json.loads(artist_ids),
+                       "artists": json.loads(artists), "tracks": json.loads(tracks), "genres": json.loads(genres)}
+            if release_type == "Album":
+                self.albums[release_id] = release
+            else:
+                self.singles[release_id] = release
+
+    # Render the html of every new album and single once, so that each recipient's email can be assembled from them
+    def _build_fragments(self):
+        self.album_fragments = {}
+        for album_id, album in self.albums.items():
+            parts = []
+            self._add_album(parts, album)
+            self.album_fragments[album_id] = "".join(parts)
+
+        self.single_fragments = {}
+        for track_id, single in self.singles.items():
+            parts = []
+            self._add_single(parts, single)
+            self.single_fragments[track_id] = "".join(parts)
+
+    # Index the new albums and singles by the genres and ids of their artists
+    def _build_indexes(self):
+        self.genre_index = {}
+        self.artist_index = {}
+        for release_id, release in list(self.albums.items()) + list(self.singles.items()):
+            for artist_id in release["artist_ids"]:
+                self.artist_index.setdefault(artist_id, set()).add(release_id)
+            for genre in release["genres"]:
+                self.genre_index.setdefault(genre, set()).add(release_id)
+
+    # Add a new album to html of email
+    def _add_album(self, parts, album):
+
+        # Add album and its artists to html of email
+        parts.append(ALBUM_HEADER_TEMPLATE.format(image_url=escape(album["image_url"]),
+                                                  name=escape(album["name"]),
+                                                  artists=_escape_list(album["artists"])))
+
+        # Add album's tracks to html of email, naming only the artists featured on them
+        for track in album["tracks"]:
+            parts.append(TRACK_TEMPLATE.format(number=track["number"],
+                                               name=_render_link(track["name"], track["preview_url"]),
+                                               featured=_render_featured(track["featured"])))
+
+        # Add album genres and release date to html of email
+        parts.append(RELEASE_FOOTER_TEMPLATE.format(genres=_render_genres(album["genres"]),
+                                                    release_date=escape(album["release_date"])))
+
+    # Add a new single to html of email
+    def _add_single(self, parts, single):
+
+        # Add single, its artists, genres and release date to html of email
+        parts.append(SINGLE_TEMPLATE.format(image_url=escape(single["image_url"]),
+                                            name=_render_link(single["name"], single["preview_url"]),
+                                            artists=_escape_list(single["artists"])))
+        parts.append(RELEASE_FOOTER_TEMPLATE.format(genres=_render_genres(single["genres"]),
+                                                    release_date=escape(single["release_date"])))
+
+    # Get ids of the new releases that match a recipient's preferences, or None if the recipient wants every release
+    def _releases_for(self, email_address):
+        preferences = self.preferences.get(email_address)
+        if not preferences:
+            return None
+
+        release_ids = set()
+        for genre in preferences["genres"]:
+            release_ids.update(self.genre_index.get(genre, ()))
+        for artist_id in preferences["artist_ids"]:
+            release_ids.update(self.artist_index.get(artist_id, ()))
+        return release_ids
+
+    # Construct html of email to send, containing only the given releases if release_ids isn't None
+    @run_metrics.timed("construct_email")
+    def _construct_email(self, release_ids=None):
+        if self.album_fragments is None:
+            self._build_fragments()
+
+        album_fragments = [fragment for album_id, fragment in self.album_fragments.items()
+                           if release_ids is None or album_id in release_ids]
+        single_fragments = [fragment for track_id, fragment in self.single_fragments.items()
+                            if release_ids is None or track_id in release_ids]
+
+        parts = [EMAIL_HEADER]
+
+        # Construct albums part of email
+        if album_fragments:
+            parts.append(SECTION_TEMPLATE.format(title="Albums"))
+            parts.extend(album_fragments)
 
         # Construct singles part of email
-        if self.new_singles:
-            self.html = self.html + "<h2 style='margin-bottom:25px;'><u>Singles</u></h2>"
+        if single_fragments:
+            parts.append(SECTION_TEMPLATE.format(title="Singles"))
+            parts.extend(single_fragments)
 
-        self._add_singles()
+        parts.append(EMAIL_FOOTER)
 
-        self.html = self.html + """
-              </body>
-            </html>
-            """
+        self.html = "".join(parts)
+        return self.html
+
+    # Queue email notifications for recipients in the outbox, each containing the new releases matching
+    # the recipient's preferences
+    @run_metrics.timed("queue_email")
+    def queue_email(self):
+
+        # Recipients receiving the same releases share a message, and the sender receives a single copy, of the digest
+        # of every release
+        digests = {None: [self.email]}
+        for row in self.recipients_df.itertuples(index=False):
+            release_ids = self._releases_for(row.EmailAddress)
+            if release_ids is None:
+                digests.setdefault(None, []).append(row.EmailAddress)
+            elif release_ids:
+                digests.setdefault(frozenset(release_ids), []).append(row.EmailAddress)
+
+        # Build one message per batch of recipients
+        messages = []
+        for release_ids, recipients in digests.items():
+            html = self._construct_email(release_ids)
 
-    # Send email notification to recipients
-    def send_email(self):
-        context = ssl.create_default_context()
-        with smtplib.SMTP_SSL(self.smtpserver, self.PORT, context=context) as server:
+            for batch in smtp_delivery.batch_recipients(recipients, self.max_recipients):
 
-            recipients = []
-            for index, row in self.recipients_df.iterrows():
-                recipients.append(row["EmailAddress"])
+                # The same releases sent to the same recipients on the same day are only ever queued once
+                key_source = json.dumps([self.collection_date, sorted(release_ids or []), release_ids is None,
+                                         sorted(batch)])
+                key = hashlib.sha256(key_source.encode("utf-8")).hexdigest()
 
-            message = MIMEMultipart("alternative")
-            message["Subject"] = "Spotify New Releases"
-            message["From"] = self.email
+                message = MIMEMultipart("alternative")
+                message["Subject"] = "Spotify New Releases"
+                message["From"] = self.email
+                message["Message-ID"] = "<" + key + "@spotify-new-release-notifier>"
 
-            # Keep recipient emails hidden from other recipients
-            message["To"] = self.email
+                # Keep recipient emails hidden from other recipients
+                message["To"] = self.email
 
-            self._construct_email()
+                htmlpart = MIMEText(html, "html", "utf-8")
+                message.attach(htmlpart)
 
-            htmlpart = MIMEText(self.html, "html")
-            message.attach(htmlpart)
+                messages.append((key, self.collection_date, batch, message.as_string()))
 
-            server.login(self.email, self.password)
-            server.sendmail(self.email, [self.email] + recipients, message.as_string())
+        sql_utils.queue_outbox_messages(self.conn, messages)
+        return len(messages)
@@ -0,0 +1,149 @@
+import settings
+
+import sql_utils
+
+from datetime import datetime
+
+import argparse
+
+import os
+
+# Queries for the ids of the releases, tracks and artists collected on a date, given as :date
+
+DATE_ALBUMS_QUERY = "SELECT AlbumID FROM Albums WHERE CollectionDate = :date"
+
+DATE_TRACKS_QUERY = "SELECT TrackID FROM Tracks WHERE SingleCollectionDate = :date " \
+                    "UNION SELECT TrackID FROM Album_Track WHERE AlbumID IN (" + DATE_ALBUMS_QUERY + ")"
+
+DATE_ARTISTS_QUERY = "SELECT ArtistID FROM Album_Artist WHERE AlbumID IN (" + DATE_ALBUMS_QUERY + ") " \
+                     "UNION SELECT ArtistID FROM Track_Artist WHERE TrackID IN (" + DATE_TRACKS_QUERY + ")"
+
+# Queries for the rows of each exported table that belong to the partition of a date: the releases collected on that
+# date along with their links, and the tracks and artists of those releases as they were stored when exporting
+
+EXPORT_QUERIES = {
+    "Albums": "SELECT {columns} FROM Albums WHERE CollectionDate = :date",
+    "Tracks": "SELECT {columns} FROM Tracks WHERE TrackID IN (" + DATE_TRACKS_QUERY + ")",
+    "Artists": "SELECT {columns} FROM Artists WHERE ArtistID IN (" + DATE_ARTISTS_QUERY + ")",
+    "Artist_Genre": "SELECT {columns} FROM Artist_Genre WHERE ArtistID IN (" + DATE_ARTISTS_QUERY + ")",
+    "Album_Artist": "SELECT {columns} FROM Album_Artist WHERE AlbumID IN (" + DATE_ALBUMS_QUERY + ")",
+    "Album_Track": "SELECT {columns} FROM Album_Track WHERE AlbumID IN (" + DATE_ALBUMS_QUERY + ")",
+    "Track_Artist": "SELECT {columns} FROM Track_Artist WHERE TrackID IN (" + DATE_TRACKS_QUERY + ")"
+}
+
+# Name of the partition column, which is stored in the directory names instead of the files
+PARTITION_COLUMN = "CollectionDate"
+
+# Arrow types of the columns of each SQLite type
+ARROW_TYPES = {"TEXT": "string", "INTEGER": "int64", "REAL": "float64"}
+
+
+# ReleaseExporter appends the release history of the new release database to Arrow IPC files partitioned by
+# collection date (<export_dir>/<table>/CollectionDate=<date>/part-0.arrow), so that it can be analysed without
+# querying the live database; files are uncompressed so that readers can memory-map them
+class ReleaseExporter:
+
+    # Number of rows read from the database and written to the file at a time
+    BATCH_ROWS = 10000
+
+    def __init__(self, conn, export_dir):
+        import pyarrow
+
+        self.pa = pyarrow
+        self.conn = conn
+        self.export_dir = export_dir
+
+        # Columns of each table along with their Arrow type, read from the database design
+        self.columns = {}
+        for table in EXPORT_QUERIES:
+            self.columns[table] = [(name, getattr(pyarrow, ARROW_TYPES[column_type])())
+                                   for _, name, column_type, _, _, _
+                                   in conn.execute("PRAGMA table_info(" + table + ")")
+                                   if name != PARTITION_COLUMN]
+
+    # Get the path of the file of a table's partition
+    def partition_path(self, table, collection_date):
+        return os.path.join(self.export_dir, table, PARTITION_COLUMN + "=" + collection_date, "part-0.arrow")
+
+    # Export the partitions of every date before the given date (today's date by default) that weren't exported yet,
+    # returning the number of partitions written; later dates may still be collected into, so they are left for a
+    # later export
+    def export(self, before_date=None):
+        before_date = before_date or datetime.today().strftime("%Y-%m-%d")
+
+        exported_count = 0
+        for collection_date in sql_utils.get_collection_dates(self.conn):
+            if collection_date >= before_date:
+                break
+
+            row_count = 0
+            written = False
+            for table in EXPORT_QUERIES:
+                if not os.path.isfile(self.partition_path(table, collection_date)):
+                    row_count += self._export_table(table, collection_date)
+                    written = True
+
+            if written:
+                exported_count += 1
+                print("Exported " + collection_date + ": " + str(row_count) + " rows")
+
+        return exported_count
+
+    # Write the partition of the given date of a table, streaming its rows from a cursor in batches, and return the
+    # number of rows written; the file is written under a temporary name first, so that a file only exists once
+    # it is complete
+    def _export_table(self, table, collection_date):
+        pa = self.pa
+        path = self.partition_path(table, collection_date)
+        temporary_path = path + ".tmp"
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        schema = pa.schema(self.columns[table])
+        cursor = self.conn.execute(EXPORT_QUERIES[table].format(columns=", ".join(schema.names)),
+                                   {"date": collection_date})
+
+        row_count = 0
+        with pa.OSFile(temporary_path, "wb") as sink, pa.ipc.new_file(sink, schema) as writer:
+            rows = cursor.fetchmany(self.BATCH_ROWS)
+            while rows:
+                columns = zip(*rows)
+                writer.write_batch(pa.record_batch([pa.array(values, type=field.type)
+                                                    for values, field in zip(columns, schema)], schema=schema))
+                row_count += len(rows)
+                rows = cursor.fetchmany(self.BATCH_ROWS)
+
+        os.replace(temporary_path, path)
+        return row_count
+
+
+# Open every exported partition of a table as a single dataset, memory-mapping its files, with the collection date of
+# each row read from the name of its partition
+def open_export(export_dir, table):
+    import pyarrow.dataset
+    import pyarrow.fs
+
+    return pyarrow.dataset.dataset(os.path.join(export_dir, table), format="ipc", partitioning="hive",
+                                   filesystem=pyarrow.fs.LocalFileSystem(use_mmap=True))
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Export the release history to Arrow IPC files partitioned by "
+                                                 "collection date")
+    parser.add_argument("--output", help="directory to export to (export_dir in config.json by default)")
+    args = parser.parse_args()
+
+    config = settings.load_config()
+    export_dir = args.output or config.export_dir
+
+    # The database is only read, so that exporting doesn't hold up a run collecting into it
+    conn = sql_utils.create_read_only_connection(config.new_release_db_path)
+    try:
+        exported_count = ReleaseExporter(conn, export_dir).export()
+        print("Partitions exported to " + export_dir + ": " + str(exported_count))
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+from metrics import run_metrics
+
+import sql_utils
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+import threading
+
+import time
+
+
+# HTTPCache keeps responses of the Spotify API in a local database, so that resources that haven't changed are
+# served locally while they are fresh and revalidated with a conditional request once they aren't, evicting the
+# least recently used responses once the cache outgrows max_bytes
+class HTTPCache:
+
+    # Fraction of max_bytes left in use after an eviction, so that the cache isn't evicted again by the next store
+    EVICTION_TARGET = 0.9
+
+    def __init__(self, conn, max_bytes):
+        self.conn = conn
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.size = sql_utils.get_http_cache_size(conn)
+
+    # Hits, revalidations, misses and evictions are counted in the metrics report, which the request threads share
+    def _count(self, name, amount=1):
+        run_metrics.count("http_cache_" + name, amount)
+
+    # Get the (ETag, body, fresh) of the cached response to the given url, or None if it isn't cached
+    def lookup(self, url):
+        with self.lock:
+            cached = sql_utils.get_cached_response(self.conn, url)
+            if cached is None:
+                return None
+            etag, body, expires_at = cached
+            now = time.time()
+            fresh = expires_at > now
+            if fresh:
+                sql_utils.touch_cached_response(self.conn, url, now)
+                self._count("hits")
+            return etag, body, fresh
+
+    # Cache the given response to the given url, if its Cache-Control header allows it and it can be reused
+    def store(self, url, response):
+        self._count("misses")
+        max_age = _max_age(response.headers)
+        etag = response.headers.get("ETag")
+        if max_age is None or (not max_age and not etag):
+            return
+
+        body = response.content
+        now = time.time()
+        with self.lock:
+            previous = sql_utils.get_cached_response(self.conn, url)
+            sql_utils.store_cached_response(self.conn, url, etag, body, now + max_age, now)
+            self.size += len(body) - (len(previous[1]) if previous else 0)
+            if self.size > self.max_bytes:
+                self._count("evictions", sql_utils.evict_cached_responses(
+                    self.conn, int(self.max_bytes * self.EVICTION_TARGET)))
+                self.size = sql_utils.get_http_cache_size(self.conn)
+
+    # Record that the cached response to the given url is still current, as the given 304 response says
+    def revalidate(self, url, response):
+        max_age = _max_age(response.headers) or 0
+        now = time.time()
+        with self.lock:
+            sql_utils.touch_cached_response(self.conn, url, now, now + max_age)
+            self._count("revalidated")
+
+
+# Get the number of seconds a response may be reused for without revalidating it according to the given headers,
+# or None if it may not be stored at all
+def _max_age(headers):
+    max_age = 0
+    for directive in headers.get("Cache-Control", "").lower().split(","):
+        name, _, value = directive.strip().partition("=")
+        if name == "no-store":
+            return None
+        if name == "no-cache":
+            return 0
+        if name == "max-age" and value.strip('"').isdigit():
+            max_age = int(value.strip('"'))
+    return max_age
+
+
+# Build a successful response to the given url out of a cached body
+def _cached_response(url, body):
+    response = requests.Response()
+    response.status_code = 200
+    response.url = url
+    response.headers["Content-Type"] = "application/json; charset=utf-8"
+    response.encoding = "utf-8"
+    response._content = body
+    return response
+
+
+# CachingSession is the requests session Spotipy sends API requests through, answering GET requests from the
+# HTTP cache where it can and sending If-None-Match for stale responses that have an ETag
+class CachingSession(requests.Session):
+
+    # Same retries of connection errors as the session Spotipy builds for itself
+    RETRIES = 3
+    BACKOFF_FACTOR = 0.3
+
+    def __init__(self, cache):
+        super().__init__()
+        self.cache = cache
+
+        # Rate limited responses and server errors are only retried by the request scheduler, which pauses every
+        # worker for the Retry-After of a 429, so urllib3 neither retries statuses nor sleeps through Retry-After
+        retry = Retry(total=self.RETRIES, connect=None, read=False,
+                      allowed_methods=frozenset(["GET", "POST", "PUT", "DELETE"]), status=0,
+                      backoff_factor=self.BACKOFF_FACTOR, respect_retry_after_header=False)
+        adapter = HTTPAdapter(max_retries=retry)
+        self.mount("http://", adapter)
+        self.mount("https://", adapter)
+
+    def request(self, method, url, params=None, headers=None, **kwargs):
+        if method != "GET":
+            return super().request(method, url, params=params, headers=headers, **kwargs)
+
+        # Responses are cached under the full url, so every page and parameter has an entry of its own
+        url = requests.Request("GET", url, params=params).prepare().url
+        cached = self.cache.lookup(url)
+        if cached and cached[2]:
+            return _cached_response(url, cached[1])
+
+        headers = dict(headers or {})
+        if cached and cached[0]:
+            headers["If-None-Match"] = cached[0]
+
+        response = super().request(method, url, headers=headers, **kwargs)
+        if response.status_code == 304 and cached:
+            self.cache.revalidate(url, response)
+            return _cached_response(url, cached[1])
+        if response.status_code == 200:
+            self.cache.store(url, response)
+        return response
@@ -1,28 +1,89 @@
-from api_client import APIClient
+from metrics import Metrics, run_metrics
 
-from email_notifier import EmailNotifier
+import settings
+
+import sql_utils
+
+from datetime import datetime
+
+import argparse
 
 
 def main():
 
-    # First, collect data from Spotify API into a local database
+    parser = argparse.ArgumentParser(description="Send email notifications of new releases on Spotify")
+    parser.add_argument("--profile", choices=Metrics.PROFILE_MODES,
+                        help="also profile the run, adding the hottest functions, allocation sites or SQL "
+                             "statements to the metrics report")
+    args = parser.parse_args()
+
+    config = settings.load_config()
+
+    # Record where the time of the run went, and write it to a metrics report once the run is over
+    run_metrics.reset(args.profile)
+    try:
+        with run_metrics.stage("main"):
+            run(config)
+    finally:
+        run_metrics.write_report(config.metrics_report_path)
+
+
+# Collect new releases, queue email notifications of them and deliver the queued emails; the modules of each step
+# are only imported once the step runs, so that a run without anything new to send never loads pandas
+def run(config):
+
+    # Both steps share the same connections to the local databases, which are closed once the run is over
+    with sql_utils.DatabaseSession(config) as session:
+
+        # First, collect data from Spotify API into a local database
+        collected_count = collect_releases(config, session)
+
+        # Next, queue an email notification for the recipients specified in the config database
+        queue_notifications(config, session, collected_count)
+
+        # Finally, deliver the queued emails, including ones that couldn't be delivered by previous runs
+        deliver_emails(config, session)
+
+
+# Collect data from Spotify API into a local database with the given client (a new one by default) under the given
+# collection date (today's date by default), returning the number of new releases collected
+def collect_releases(config, session, spotify_client=None, collection_date=None):
     try:
-        spotify_client = APIClient()
-        spotify_client.collect_data()
+        if spotify_client is None:
+            from api_client import APIClient
+
+            spotify_client = APIClient(config, session)
+        collected_count = spotify_client.collect_data(collection_date)
         print("Data collected from Spotify\n")
+        return collected_count
     except Exception as e:
         print("Exception: " + str(e))
+        return 0
 
-    # Next, send an email notification to the recipients specified in the config database
+
+# Queue an email notification of the releases collected on the given collection date (today's date by default)
+# for the recipients specified in the config database
+def queue_notifications(config, session, collected_count, collection_date=None):
     try:
-        notifier = EmailNotifier()
+        collection_date = collection_date or datetime.today().strftime("%Y-%m-%d")
+
+        # Nothing needs to be sent if nothing was collected on the collection date, or if emails of its releases were
+        # already queued and nothing new was collected since
+        if not sql_utils.has_releases(session.conn, collection_date) or \
+                (not collected_count and sql_utils.has_queued_emails(session.conn, collection_date)):
+            print("No new releases")
+            return
+
+        from email_notifier import EmailNotifier
+
+        notifier = EmailNotifier(config, session)
 
-        new_data = notifier.get_data_to_send()
+        new_data = notifier.get_data_to_send(collection_date)
 
-        # Send email only if there are new releases to send
+        # Queue email only if there are new releases to send
         if new_data:
-            notifier.send_email()
-            print("Email sent")
+            queued_count = notifier.queue_email()
+            print("Emails queued: " + str(queued_count))
         else:
             print("No new releases")
 
@@ -30,5 +91,16 @@ def main():
         print("Exception: " + str(e))
 
 
+# Deliver the queued emails that are due, including ones that couldn't be delivered by previous runs
+def deliver_emails(config, session):
+    try:
+        from outbox import Outbox
+
+        sent_count, failed_count = Outbox(config, session).deliver()
+        print("Emails sent: " + str(sent_count) + ", failed: " + str(failed_count))
+    except Exception as e:
+        print("Exception: " + str(e))
+
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,254 @@
+from contextlib import contextmanager
+
+from datetime import datetime
+
+import cProfile
+
+import functools
+
+import json
+
+import pstats
+
+import re
+
+import threading
+
+import time
+
+import tracemalloc
+
+
+# Metrics records where the time of a run went: how long each stage took, which Spotify API endpoints were
+# requested (and retried), and, when profiling SQL, which SQL statements were executed, and writes it all to a JSON
+# report
+class Metrics:
+
+    PROFILE_MODES = ("cprofile", "tracemalloc", "sql")
+
+    # Number of SQLite virtual machine instructions between calls to the progress handler
+    PROGRESS_INTERVAL = 1000
+
+    # Number of functions or allocation sites listed in the report when profiling
+    PROFILE_TOP = 25
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    # Every thread has its own stack of running stages, so that what a thread records is credited to its own stages
+    @property
+    def stage_stack(self):
+        if not hasattr(self.threads, "stage_stack"):
+            self.threads.stage_stack = []
+        return self.threads.stage_stack
+
+    # Forget everything recorded so far, e.g. before the next run of a long running process
+    def reset(self, profile_mode=None):
+        if profile_mode not in (None,) + self.PROFILE_MODES:
+            raise Exception("Unknown profile mode: " + str(profile_mode))
+
+        self.started_at = datetime.now()
+        self.start = time.perf_counter()
+        self.stages = {}
+        self.threads = threading.local()
+        self.requests = {}
+        self.counters = {}
+        self.statements = {}
+        self.statement_keys = {}
+        self.pending_statement = None
+        self.profile_mode = profile_mode
+        self.profiler = None
+
+        if profile_mode == "cprofile":
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        elif profile_mode == "tracemalloc":
+            tracemalloc.start()
+
+    # Time the code run inside this context as a stage nested in the stages that are already running
+    @contextmanager
+    def stage(self, name):
+        self._finish_statement()
+        path = self.child_stage(name)
+        frame = {"path": path, "start": time.perf_counter(), "child_peak": 0}
+        if self.profile_mode == "tracemalloc":
+            tracemalloc.reset_peak()
+        self.stage_stack.append(frame)
+        try:
+            yield
+        finally:
+            self._finish_statement()
+            self.stage_stack.pop()
+            stage = self._stage_stats(path)
+            stage["calls"] += 1
+            stage["seconds"] += time.perf_counter() - frame["start"]
+
+            # The peak is reset whenever a stage starts, so a stage's peak also covers the peaks of its children
+            if self.profile_mode == "tracemalloc":
+                peak = max(tracemalloc.get_traced_memory()[1], frame["child_peak"])
+                stage["peak_memory_bytes"] = max(stage.get("peak_memory_bytes", 0), peak)
+                if self.stage_stack:
+                    self.stage_stack[-1]["child_peak"] = max(self.stage_stack[-1]["child_peak"], peak)
+
+    # Credit what the calling thread records inside this context to the stage with the given path (if any), which
+    # was started by another thread handing work over to this one and is timed by that thread
+    @contextmanager
+    def in_stage(self, path):
+        if path is None:
+            yield
+            return
+
+        self.stage_stack.append({"path": path, "start": time.perf_counter(), "child_peak": 0})
+        try:
+            yield
+        finally:
+            self.stage_stack.pop()
+
+    # Get the path of a stage with the given name nested in the stage running on the calling thread
+    def child_stage(self, name):
+        return "/".join([frame["path"] for frame in self.stage_stack[-1:]] + [name])
+
+    # Get the path of the stage running on the calling thread, if any
+    def current_stage(self):
+        return self.stage_stack[-1]["path"] if self.stage_stack else None
+
+    # Decorator timing every call of a function as a stage
+    def timed(self, name):
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.stage(name):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def _stage_stats(self, path):
+        stage = self.stages.get(path)
+        if stage is None:
+            stage = self.stages[path] = {"calls": 0, "seconds": 0.0, "spotify_requests": 0}
+            if self.profile_mode == "sql":
+                stage.update(sql_statements=0, sql_seconds=0.0)
+        return stage
+
+    # Record a Spotify API request to the given endpoint that took seconds (including waiting for the rate limiter)
+    # and was retried retries times
+    def record_request(self, endpoint, seconds, retries, failed=False):
+        with self.lock:
+            request = self.requests.setdefault(endpoint, {"calls": 0, "retries": 0, "failures": 0, "seconds": 0.0})
+            request["calls"] += 1
+            request["retries"] += retries
+            request["failures"] += failed
+            request["seconds"] += seconds
+            stage = self.current_stage()
+            if stage:
+                self._stage_stats(stage)["spotify_requests"] += 1
+
+    # Add amount to the counter with the given name
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    # Record every SQL statement executed on the given connection under the given database name when profiling SQL;
+    # the trace callback runs for every row of an executemany, which slows bulk inserts down a lot, so statements
+    # aren't traced otherwise
+    def watch_connection(self, conn, database):
+        if self.profile_mode != "sql":
+            return
+
+        conn.set_trace_callback(lambda sql: self._start_statement(conn, database, sql))
+        conn.set_progress_handler(self._progress, self.PROGRESS_INTERVAL)
+
+    # Statements are traced with their bound values expanded, so literals are replaced by ? to group executions
+    # of the same statement together
+    def _statement_key(self, sql):
+        prefix = sql.split("'", 1)[0]
+        key = self.statement_keys.get(prefix)
+        if key is None:
+            key = re.sub(r"\b\d+(\.\d+)?\b", "?", " ".join(prefix.split()))
+            if len(prefix) < len(sql):
+                key += " ..."
+            self.statement_keys[prefix] = key
+        return key
+
+    def _start_statement(self, conn, database, sql):
+        self._finish_statement()
+        self.pending_statement = {"conn": conn, "database": database, "key": self._statement_key(sql),
+                                  "stage": self.current_stage(), "start": time.perf_counter(),
+                                  "changes": conn.total_changes, "vm_steps": 0}
+
+    def _progress(self):
+        if self.pending_statement:
+            self.pending_statement["vm_steps"] += self.PROGRESS_INTERVAL
+
+    # The trace callback only reports when statements start, so a statement is finished by the next statement or
+    # stage boundary on any connection, and its time is an upper bound of the time spent executing it
+    def _finish_statement(self):
+        pending = self.pending_statement
+        if pending is None:
+            return
+        self.pending_statement = None
+
+        seconds = time.perf_counter() - pending["start"]
+        statement = self.statements.setdefault(pending["database"], {}).setdefault(
+            pending["key"], {"executions": 0, "seconds": 0.0, "rows_changed": 0, "vm_steps": 0})
+        statement["executions"] += 1
+        statement["seconds"] += seconds
+        statement["vm_steps"] += pending["vm_steps"]
+        try:
+            statement["rows_changed"] += pending["conn"].total_changes - pending["changes"]
+        except Exception:
+            # The connection was closed since the statement ran
+            pass
+
+        if pending["stage"]:
+            stage = self._stage_stats(pending["stage"])
+            stage["sql_statements"] += 1
+            stage["sql_seconds"] += seconds
+
+    # Stop profiling and build the report of everything recorded since the last reset
+    def report(self):
+        self._finish_statement()
+        report = {
+            "started_at": self.started_at.strftime("%Y-%m-%d %H:%M:%S"),
+            "seconds": round(time.perf_counter() - self.start, 4),
+            "stages": {path: _rounded(stage) for path, stage in self.stages.items()},
+            "spotify_requests": {endpoint: _rounded(request) for endpoint, request in sorted(self.requests.items())},
+            "counters": dict(sorted(self.counters.items()))
+        }
+
+        if self.profile_mode == "sql":
+            report["sql_statements"] = {database: {key: _rounded(statement) for key, statement in
+                                                   sorted(statements.items(), key=lambda item: -item[1]["seconds"])}
+                                        for database, statements in self.statements.items()}
+        elif self.profile_mode == "cprofile":
+            self.profiler.disable()
+            stats = pstats.Stats(self.profiler)
+            top = sorted(stats.stats.items(), key=lambda item: -item[1][3])[:self.PROFILE_TOP]
+            report["profile"] = [{"function": file + ":" + str(line) + "(" + function + ")", "calls": calls,
+                                  "own_seconds": round(own, 4), "cumulative_seconds": round(cumulative, 4)}
+                                 for (file, line, function), (_, calls, own, cumulative, _) in top]
+        elif self.profile_mode == "tracemalloc":
+            snapshot = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+            report["profile"] = [{"location": str(statistic.traceback), "size_bytes": statistic.size,
+                                  "count": statistic.count}
+                                 for statistic in snapshot.statistics("lineno")[:self.PROFILE_TOP]]
+        self.profile_mode = None
+        return report
+
+    # Write the report of everything recorded since the last reset to the JSON file at the given path
+    def write_report(self, path):
+        report = self.report()
+        with open(path, "w") as report_file:
+            json.dump(report, report_file, indent=2)
+        print("Metrics written to " + path)
+        return report
+
+
+def _rounded(stats):
+    return {name: round(value, 4) if isinstance(value, float) else value for name, value in stats.items()}
+
+
+# Metrics of the current run, shared by every module taking part in it
+run_metrics = Metrics()
@@ -0,0 +1,59 @@
+import sql_utils
+
+from metrics import run_metrics
+
+import smtp_delivery
+
+
+# Outbox delivers the emails queued in the local database, retrying failed deliveries with exponential backoff
+# until they are sent or run out of attempts
+class Outbox:
+
+    PORT = 465
+
+    def __init__(self, config, session):
+
+        # Use the run's connection to local database storing the queued emails
+        self.conn = session.conn
+
+        # Obtain info for the sender email from config.json
+        self.email = config.sender_email
+        self.password = config.sender_password
+        self.smtpserver = config.smtp_server
+
+        # Obtain limits of the SMTP server and retry settings from config.json
+        self.smtp_connections = config.smtp_connections
+        self.messages_per_second = config.smtp_messages_per_second
+        self.max_attempts = config.outbox_max_attempts
+        self.retry_seconds = config.outbox_retry_seconds
+
+    # Attempt to deliver every queued email that is due, returning the number of emails sent and failed; the result
+    # of each email is recorded as soon as it is done, so that emails sent before a crash aren't sent again
+    @run_metrics.timed("deliver")
+    def deliver(self):
+        due_messages = sql_utils.get_due_outbox_messages(self.conn)
+        if not due_messages:
+            return 0, 0
+
+        pool = smtp_delivery.SMTPConnectionPool(self.smtpserver, self.PORT, self.email, self.password,
+                                                self.smtp_connections)
+        try:
+            engine = smtp_delivery.DeliveryEngine(pool, self.messages_per_second)
+            errors = engine.send(self.email, [(recipients, message) for _, recipients, message, _ in due_messages],
+                                 lambda index, error: self._record_result(due_messages[index], error))
+        finally:
+            pool.close()
+
+        sent_count = errors.count(None)
+        return sent_count, len(due_messages) - sent_count
+
+    # Mark a queued email as sent, or record its failed attempt, to be retried with exponential backoff unless it
+    # ran out of attempts
+    def _record_result(self, due_message, error):
+        message_id, _, _, attempts = due_message
+        if error is None:
+            sql_utils.mark_outbox_sent(self.conn, message_id)
+        elif attempts + 1 >= self.max_attempts:
+            sql_utils.mark_outbox_failed(self.conn, message_id, str(error), None)
+        else:
+            sql_utils.mark_outbox_failed(self.conn, message_id, str(error), self.retry_seconds * 2 ** attempts)
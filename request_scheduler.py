@@ -0,0 +1,104 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from spotipy.exceptions import SpotifyException
+
+from metrics import run_metrics
+
+import random
+
+import threading
+
+import time
+
+
+# TokenBucket limits the rate at which requests are sent, allowing short bursts up to its capacity, which is at
+# least the single token a request takes so that rates below one per second still let requests through
+class TokenBucket:
+
+    def __init__(self, rate, capacity=None):
+        if rate <= 0:
+            raise Exception("Rate must be positive: " + str(rate))
+
+        self.rate = rate
+        self.capacity = max(1, capacity or rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0
+        self.lock = threading.Lock()
+
+    # Block until a token is available, then take it
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+
+                if now < self.paused_until:
+                    wait = self.paused_until - now
+                elif self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                else:
+                    wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    # Stop handing out tokens to every worker for the given number of seconds
+    def pause(self, seconds):
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.tokens = 0
+
+
+# RequestScheduler sends API requests from a pool of worker threads through a shared rate limiter,
+# backing off and retrying when Spotify responds with 429 Too Many Requests or a server error
+class RequestScheduler:
+
+    BASE_BACKOFF = 1
+    MAX_BACKOFF = 60
+
+    def __init__(self, workers, requests_per_second, max_retries):
+        self.workers = workers
+        self.max_retries = max_retries
+        self.bucket = TokenBucket(requests_per_second)
+
+    # Send a single request, retrying it if it was rate limited or failed on the server's side
+    def call(self, func, *args, **kwargs):
+        start = time.perf_counter()
+        attempt = 0
+        while True:
+            self.bucket.acquire()
+            try:
+                result = func(*args, **kwargs)
+                run_metrics.record_request(func.__name__, time.perf_counter() - start, attempt)
+                return result
+            except SpotifyException as e:
+                if (e.http_status != 429 and e.http_status < 500) or attempt >= self.max_retries:
+                    run_metrics.record_request(func.__name__, time.perf_counter() - start, attempt, failed=True)
+                    raise
+
+                # Full jitter exponential backoff, but never sooner than Spotify asked for
+                delay = random.uniform(0, min(self.MAX_BACKOFF, self.BASE_BACKOFF * 2 ** attempt))
+                headers = getattr(e, "headers", None) or {}
+                retry_after = headers.get("Retry-After")
+                if e.http_status == 429 and retry_after:
+                    delay += float(retry_after)
+                    self.bucket.pause(delay)
+                time.sleep(delay)
+                attempt += 1
+
+    # Send one request per item of args_list concurrently, returning results in the same order; requests are
+    # credited to the stage of the calling thread
+    def map(self, func, args_list):
+        args_list = list(args_list)
+        if len(args_list) <= 1 or self.workers <= 1:
+            return [self.call(func, *args) for args in args_list]
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = [executor.submit(self._call_in_stage, run_metrics.current_stage(), func, *args)
+                       for args in args_list]
+            return [future.result() for future in futures]
+
+    def _call_in_stage(self, stage, func, *args):
+        with run_metrics.in_stage(stage):
+            return self.call(func, *args)
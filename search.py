@@ -0,0 +1,50 @@
+import settings
+
+import sql_utils
+
+import argparse
+
+import time
+
+
+# Parse a page number or page size, which must be at least 1 (SQLite reads a negative LIMIT as no limit at all)
+def positive_int(value):
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError("must be at least 1: " + value)
+    return number
+
+
+# Print the given page of the releases matching a search, e.g. to check whether a release was already sent
+def print_results(results, page, elapsed):
+    for result in results:
+        print(result["collection_date"] + "  " + result["release_type"].ljust(6) + "  " + result["name"] + " by " +
+              ", ".join(result["artists"]) + "  (" + result["release_id"] + ")")
+    print("Page " + str(page) + ": " + str(len(results)) + " releases in " + "{:.1f}".format(elapsed * 1000) + " ms")
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Search the releases collected so far by name, artist, track or "
+                                                 "genre, best matches first")
+    parser.add_argument("text", help="words that every matching release contains")
+    parser.add_argument("--in", dest="column", choices=sql_utils.RELEASE_SEARCH_COLUMNS,
+                        help="only search the release names, artists, track names or genres")
+    parser.add_argument("--page", type=positive_int, default=1, help="page of matches to show")
+    parser.add_argument("--page-size", type=positive_int, default=20, help="number of matches on a page")
+    args = parser.parse_args()
+
+    config = settings.load_config()
+
+    # The database is only read, so that searching doesn't hold up a run collecting into it
+    conn = sql_utils.create_read_only_connection(config.new_release_db_path)
+    try:
+        start = time.perf_counter()
+        results = sql_utils.search_releases(conn, args.text, args.column, args.page, args.page_size)
+        print_results(results, args.page, time.perf_counter() - start)
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+from dataclasses import dataclass, fields
+
+import json
+
+CONFIG_PATH = "config.json"
+
+
+# Config holds the settings of the application read from config.json, converted to the type of each setting
+@dataclass(frozen=True)
+class Config:
+
+    # Application registered on the Spotify for Developers Dashboard
+    spotify_client_id: str
+    spotify_client_secret: str
+
+    # Sender email address and the SMTP server it sends through
+    sender_email: str
+    sender_password: str
+    smtp_server: str
+
+    # Local databases
+    new_release_db_path: str
+    config_db_path: str
+
+    # Collection of new releases from Spotify API
+    new_release_number: int = 10
+    known_release_stop: int = 5
+    artist_cache_ttl_days: float = 7
+    fetch_workers: int = 8
+    requests_per_second: float = 10
+    max_request_retries: int = 5
+    http_cache_max_mb: float = 64
+
+    # Releases committed together, and chunks of releases whose tracks are loaded ahead of the chunk being stored
+    collection_commit_releases: int = 100
+    collection_prefetch_chunks: int = 1
+    spotify_api_prefix: str = None
+
+    # Markets (ISO 3166-1 alpha-2 country codes) whose new release feeds are collected, or the feed Spotify picks
+    # for the account if empty
+    markets: list = ()
+
+    # Delivery of email notifications
+    smtp_connections: int = 3
+    smtp_messages_per_second: float = 5
+    smtp_max_recipients: int = 50
+    outbox_max_attempts: int = 8
+    outbox_retry_seconds: float = 60
+
+    metrics_report_path: str = "metrics.json"
+
+    # Directory exporter.py appends the release history to
+    export_dir: str = "export"
+
+    # Schedules of daemon.py: collection every few minutes, and a daily digest of the releases collected since the
+    # previous one at the given local time (HH:MM)
+    daemon_collection_interval_minutes: float = 60
+    daemon_notification_time: str = "08:00"
+
+    # Spotify account and redirect uri of the user authorization flow that tokens used to be obtained with, no longer
+    # used but still accepted so that existing config files load
+    spotify_username: str = None
+    spotify_redirect_uri: str = None
+
+    # Rate limits, which must be positive
+    RATE_SETTINGS = ("requests_per_second", "smtp_messages_per_second")
+
+    # Build a Config out of the settings in the given dict, raising an exception for unknown or missing settings
+    # and for settings that can't be converted to their type
+    @classmethod
+    def from_dict(cls, settings):
+        known = {field.name: field for field in fields(cls)}
+        unknown = [name for name in settings if name not in known]
+        if unknown:
+            raise Exception("Unknown settings in " + CONFIG_PATH + ": " + ", ".join(unknown))
+
+        values = {}
+        for name, value in settings.items():
+            if value is not None:
+                try:
+                    value = known[name].type(value)
+                except (TypeError, ValueError):
+                    raise Exception("Setting " + name + " in " + CONFIG_PATH + " must be of type " +
+                                    known[name].type.__name__)
+            values[name] = value
+
+        for name in cls.RATE_SETTINGS:
+            if values.get(name) is not None and values[name] <= 0:
+                raise Exception("Setting " + name + " in " + CONFIG_PATH + " must be greater than 0")
+
+        try:
+            return cls(**values)
+        except TypeError as e:
+            raise Exception("Missing settings in " + CONFIG_PATH + ": " + str(e))
+
+
+_config = None
+
+
+# Load application configuration from config.json the first time it is needed, and reuse it afterwards
+def load_config():
+    global _config
+    if _config is None:
+        with open(CONFIG_PATH) as config_file:
+            _config = Config.from_dict(json.load(config_file))
+    return _config
@@ -0,0 +1,139 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from metrics import run_metrics
+
+from request_scheduler import TokenBucket
+
+import queue
+
+import smtplib
+import ssl
+
+import threading
+
+
+# SMTPConnectionPool keeps a small number of authenticated SMTP connections that are reused across messages
+class SMTPConnectionPool:
+
+    def __init__(self, server, port, email, password, size, use_ssl=True):
+        self.server = server
+        self.port = port
+        self.email = email
+        self.password = password
+        self.size = size
+        self.use_ssl = use_ssl
+        self.idle = queue.LifoQueue()
+        self.open_count = 0
+        self.lock = threading.Lock()
+
+    # Open and authenticate a new connection to the SMTP server
+    def _open(self):
+        if self.use_ssl:
+            conn = smtplib.SMTP_SSL(self.server, self.port, context=ssl.create_default_context())
+        else:
+            conn = smtplib.SMTP(self.server, self.port)
+        if self.password:
+            conn.login(self.email, self.password)
+        return conn
+
+    # Take an idle connection, opening a new one if fewer than size connections are open, or wait for one
+    def acquire(self):
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self.lock:
+            can_open = self.open_count < self.size
+            if can_open:
+                self.open_count += 1
+        if not can_open:
+            return self.idle.get()
+
+        try:
+            return self._open()
+        except Exception:
+            with self.lock:
+                self.open_count -= 1
+            raise
+
+    # Return a connection to the pool, or close it if it can't be used anymore
+    def release(self, conn, broken=False):
+        if not broken:
+            self.idle.put(conn)
+            return
+
+        with self.lock:
+            self.open_count -= 1
+        try:
+            conn.close()
+        except smtplib.SMTPException:
+            pass
+
+    # Close every idle connection
+    def close(self):
+        while True:
+            try:
+                conn = self.idle.get_nowait()
+            except queue.Empty:
+                return
+            with self.lock:
+                self.open_count -= 1
+            try:
+                conn.quit()
+            except smtplib.SMTPException:
+                conn.close()
+
+
+# DeliveryEngine sends messages in parallel over a pool of SMTP connections, at no more than messages_per_second
+class DeliveryEngine:
+
+    def __init__(self, pool, messages_per_second):
+        self.pool = pool
+        self.bucket = TokenBucket(messages_per_second)
+
+    # Send a single message, reconnecting once if the server closed the connection it was sent on
+    def _send(self, sender, recipients, message):
+        self.bucket.acquire()
+        for attempt in range(2):
+            conn = self.pool.acquire()
+            try:
+                conn.sendmail(sender, recipients, message)
+            except smtplib.SMTPServerDisconnected:
+                self.pool.release(conn, broken=True)
+                if attempt:
+                    raise
+                continue
+            except Exception:
+                self.pool.release(conn, broken=True)
+                raise
+            self.pool.release(conn)
+            return
+
+    # Send a single message, returning the exception that stopped it from being sent, if any
+    def _try_send(self, sender, recipients, message):
+        try:
+            self._send(sender, recipients, message)
+        except Exception as e:
+            return e
+
+    # Send each (recipients, message) pair of messages, returning for each one None if it was sent,
+    # or the exception that stopped it from being sent; on_result, if given, is called with the index of each
+    # message and its result as soon as that message is done, on the calling thread
+    @run_metrics.timed("smtp_send")
+    def send(self, sender, messages, on_result=None):
+        results = [None] * len(messages)
+        with ThreadPoolExecutor(max_workers=self.pool.size) as executor:
+            futures = {executor.submit(self._try_send, sender, recipients, message): index
+                       for index, (recipients, message) in enumerate(messages)}
+            for future in as_completed(futures):
+                index = futures[future]
+                results[index] = future.result()
+                if on_result is not None:
+                    on_result(index, results[index])
+        return results
+
+
+# Split recipients into batches of at most max_recipients, as many as most SMTP providers accept per message
+def batch_recipients(recipients, max_recipients):
+    return [recipients[i:i + max_recipients] for i in range(0, len(recipients), max_recipients)]
@@ -3,16 +3,23 @@ from sqlite3 import Error
 
 import os.path
 
+import pathlib
+
 import json
 
-with open("config.json") as config_file:
-    config = json.load(config_file)
+from metrics import run_metrics
 
-# Local SQLite database storing new release data obtained from Spotify API
-SQLITE_PATH = config["new_release_db_path"]
+from datetime import datetime, timedelta
 
-# Local SQLite database storing extra application configuration
-CONFIG_DB_PATH = config["config_db_path"]
+# Settings applied to every connection to the new release database: write-ahead logging so that reads don't block
+# on writes, fewer fsyncs, a 64 MB page cache, memory-mapped reads and enforced foreign keys
+RELEASE_DB_PRAGMAS = [
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA cache_size = -65536",
+    "PRAGMA mmap_size = 268435456",
+    "PRAGMA foreign_keys = ON"
+]
 
 CREATE_ALBUMS_TABLE = "CREATE TABLE Albums (" \
                       "AlbumID TEXT PRIMARY KEY, " \
@@ -70,6 +77,180 @@ CREATE_TRACK_ARTIST_TABLE = "CREATE TABLE Track_Artist (" \
                             "FOREIGN KEY (ArtistID) REFERENCES Artists(ArtistID)" \
                             ");"
 
+CREATE_ARTIST_CACHE_TABLE = "CREATE TABLE IF NOT EXISTS Artist_Cache (" \
+                            "ArtistID TEXT PRIMARY KEY, " \
+                            "FetchedAt TEXT, " \
+                            "FOREIGN KEY (ArtistID) REFERENCES Artists(ArtistID)" \
+                            ");"
+
+CREATE_SEEN_RELEASES_TABLE = "CREATE TABLE IF NOT EXISTS Seen_Releases (" \
+                             "ReleaseID TEXT PRIMARY KEY, " \
+                             "CollectionDate TEXT" \
+                             ");"
+
+CREATE_ALBUMS_COLLECTION_DATE_INDEX = "CREATE INDEX IF NOT EXISTS Albums_CollectionDate " \
+                                      "ON Albums (CollectionDate);"
+
+CREATE_TRACKS_SINGLE_COLLECTION_DATE_INDEX = "CREATE INDEX IF NOT EXISTS Tracks_SingleCollectionDate " \
+                                             "ON Tracks (SingleCollectionDate);"
+
+CREATE_TRACK_ARTIST_ARTIST_INDEX = "CREATE INDEX IF NOT EXISTS Track_Artist_ArtistID " \
+                                   "ON Track_Artist (ArtistID, TrackID);"
+
+CREATE_ALBUM_ARTIST_ARTIST_INDEX = "CREATE INDEX IF NOT EXISTS Album_Artist_ArtistID " \
+                                   "ON Album_Artist (ArtistID, AlbumID);"
+
+CREATE_ALBUM_TRACK_TRACK_INDEX = "CREATE INDEX IF NOT EXISTS Album_Track_TrackID " \
+                                 "ON Album_Track (TrackID, AlbumID);"
+
+CREATE_OUTBOX_TABLE = "CREATE TABLE Outbox (" \
+                      "MessageID INTEGER PRIMARY KEY, " \
+                      "IdempotencyKey TEXT UNIQUE, " \
+                      "CollectionDate TEXT, " \
+                      "Recipients TEXT, " \
+                      "Message TEXT, " \
+                      "Status TEXT CHECK (Status IN ('Pending', 'Sent', 'Failed')), " \
+                      "Attempts INTEGER DEFAULT 0, " \
+                      "NextAttemptAt TEXT, " \
+                      "LastError TEXT, " \
+                      "SentAt TEXT" \
+                      ");"
+
+CREATE_OUTBOX_STATUS_INDEX = "CREATE INDEX IF NOT EXISTS Outbox_Status ON Outbox (Status, NextAttemptAt);"
+
+# Markets whose new release feed listed each release
+CREATE_RELEASE_MARKET_TABLE = "CREATE TABLE Release_Market (" \
+                              "ReleaseID TEXT, " \
+                              "Market TEXT, " \
+                              "CollectionDate TEXT, " \
+                              "PRIMARY KEY (ReleaseID, Market)" \
+                              ");"
+
+# Digest of each release as it is sent in the email of its collection date, denormalized so that a day's digest is
+# read with a single range scan of the primary key: artists are listed by popularity, tracks by track number along
+# with the artists featured on them, and the genres of the release's artists are de-duplicated; ReleaseID is the
+# TrackID of singles, and Popularity is the popularity of the release's most popular artist
+CREATE_RELEASE_DIGEST_TABLE = "CREATE TABLE Release_Digest (" \
+                              "CollectionDate TEXT, " \
+                              "ReleaseID TEXT, " \
+                              "ReleaseType TEXT CHECK (ReleaseType IN ('Album', 'Single')), " \
+                              "Name TEXT, " \
+                              "ReleaseDate TEXT, " \
+                              "ImageURL TEXT, " \
+                              "PreviewURL TEXT, " \
+                              "Popularity INTEGER, " \
+                              "ArtistIDs TEXT, " \
+                              "Artists TEXT, " \
+                              "Tracks TEXT, " \
+                              "Genres TEXT, " \
+                              "PRIMARY KEY (CollectionDate, ReleaseID)" \
+                              ");"
+
+# Full-text index of the name, artists (including the artists featured on tracks), track names and genres of every
+# release in Release_Digest, sharing its rowid; matches are ranked by BM25, weighing a match in the name of the release
+# above one in its artists, tracks or genres
+CREATE_RELEASE_SEARCH_TABLE = "CREATE VIRTUAL TABLE Release_Search USING fts5(" \
+                              "Name, " \
+                              "Artists, " \
+                              "Tracks, " \
+                              "Genres, " \
+                              "tokenize = 'unicode61 remove_diacritics 2'" \
+                              ");"
+
+RELEASE_SEARCH_COLUMNS = ("Name", "Artists", "Tracks", "Genres")
+
+SET_RELEASE_SEARCH_RANK = "INSERT INTO Release_Search (Release_Search, rank) " \
+                          "VALUES ('rank', 'bm25(10.0, 5.0, 2.0, 1.0)');"
+
+# Text indexed for the releases in Release_Digest, pulled out of its JSON columns
+RELEASE_SEARCH_TEXT_QUERY = "SELECT rowid, Name, " \
+                            "(SELECT group_concat(value, ', ') FROM (" \
+                            "SELECT value FROM json_each(Release_Digest.Artists) " \
+                            "UNION SELECT Featured.value FROM json_each(Release_Digest.Tracks) AS Track, " \
+                            "json_each(Track.value, '$.featured') AS Featured)), " \
+                            "(SELECT group_concat(json_extract(value, '$.name'), ', ') " \
+                            "FROM json_each(Release_Digest.Tracks)), " \
+                            "(SELECT group_concat(value, ', ') FROM json_each(Release_Digest.Genres)) " \
+                            "FROM Release_Digest"
+
+# Changes to the database design of the new release database, in the order they are applied to it; a database's
+# "PRAGMA user_version" is the number of migrations that have been applied to it
+MIGRATIONS = [
+    # 1: Indexes for the queries run by EmailNotifier, along with the tables supporting APIClient's caches
+    [
+        CREATE_ALBUMS_COLLECTION_DATE_INDEX,
+        CREATE_TRACKS_SINGLE_COLLECTION_DATE_INDEX,
+        CREATE_TRACK_ARTIST_ARTIST_INDEX,
+        CREATE_ALBUM_ARTIST_ARTIST_INDEX,
+        CREATE_ARTIST_CACHE_TABLE,
+        CREATE_SEEN_RELEASES_TABLE
+    ],
+    # 2: Outbox of rendered emails waiting to be delivered
+    [
+        CREATE_OUTBOX_TABLE,
+        CREATE_OUTBOX_STATUS_INDEX
+    ],
+    # 3: Availability of releases in the markets whose feeds are collected
+    [
+        CREATE_RELEASE_MARKET_TABLE
+    ],
+    # 4: Digest of each release, filled with the releases collected before it existed (functions are called with
+    # the connection; they are looked up when the migration runs, since they are defined further down)
+    [
+        CREATE_RELEASE_DIGEST_TABLE,
+        CREATE_ALBUM_TRACK_TRACK_INDEX,
+        lambda conn: backfill_release_digest(conn)
+    ],
+    # 5: Full-text search of the releases in the digest
+    [
+        CREATE_RELEASE_SEARCH_TABLE,
+        SET_RELEASE_SEARCH_RANK,
+        "INSERT INTO Release_Search (rowid, Name, Artists, Tracks, Genres) " + RELEASE_SEARCH_TEXT_QUERY
+    ]
+]
+
+# Genres and artists that a recipient wants to be notified about; recipients without any receive every release
+CREATE_RECIPIENT_PREFERENCES_TABLE = "CREATE TABLE IF NOT EXISTS Recipient_Preferences (" \
+                                     "EmailAddress TEXT, " \
+                                     "PreferenceType TEXT CHECK (PreferenceType IN ('Genre', 'Artist')), " \
+                                     "Value TEXT, " \
+                                     "PRIMARY KEY (EmailAddress, PreferenceType, Value)" \
+                                     ");"
+
+# Responses of the Spotify API kept by the HTTP cache, along with their ETag for conditional requests; times are
+# seconds since the epoch so that entries can be ordered by last use with sub-second resolution
+CREATE_HTTP_CACHE_TABLE = "CREATE TABLE IF NOT EXISTS HTTP_Cache (" \
+                          "URL TEXT PRIMARY KEY, " \
+                          "ETag TEXT, " \
+                          "Body BLOB, " \
+                          "Size INTEGER, " \
+                          "ExpiresAt REAL, " \
+                          "LastUsedAt REAL" \
+                          ");"
+
+CREATE_HTTP_CACHE_LAST_USED_INDEX = "CREATE INDEX IF NOT EXISTS HTTP_Cache_LastUsedAt ON HTTP_Cache (LastUsedAt);"
+
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+# Maximum number of ids bound to a single "IN (...)" clause
+MAX_QUERY_IDS = 500
+
+# Queries for the albums and singles collected on a date that any of the artists whose placeholders replace {ids} took
+# part in (the unary + keeps SQLite from scanning every release of the date through the collection date indexes, so
+# that the releases are found through the artists' relationships)
+
+ARTIST_ALBUMS_QUERY = "SELECT Albums.AlbumID FROM Album_Artist " \
+                      "INNER JOIN Albums ON Album_Artist.AlbumID = Albums.AlbumID " \
+                      "WHERE ArtistID IN ({ids}) AND +CollectionDate = ? " \
+                      "UNION SELECT Albums.AlbumID FROM Track_Artist " \
+                      "INNER JOIN Album_Track ON Track_Artist.TrackID = Album_Track.TrackID " \
+                      "INNER JOIN Albums ON Album_Track.AlbumID = Albums.AlbumID " \
+                      "WHERE ArtistID IN ({ids}) AND +CollectionDate = ?"
+
+ARTIST_SINGLES_QUERY = "SELECT Tracks.TrackID FROM Track_Artist " \
+                       "INNER JOIN Tracks ON Track_Artist.TrackID = Tracks.TrackID " \
+                       "WHERE ArtistID IN ({ids}) AND +SingleCollectionDate = ?"
+
 
 # Connect to a SQLite database
 def _connect(db_file):
@@ -81,6 +262,12 @@ def _connect(db_file):
         print(e)
 
 
+# Apply the connection settings for the new release database to the given SQLite conn
+def tune_connection(conn):
+    for pragma in RELEASE_DB_PRAGMAS:
+        conn.execute(pragma)
+
+
 # Create a table with the given SQLite conn
 def create_table(conn, create_table_sql):
     try:
@@ -90,29 +277,525 @@ def create_table(conn, create_table_sql):
         print(e)
 
 
+# Create the database design of the new release database with the given SQLite conn, including every migration
+def create_release_tables(conn):
+    create_table(conn, CREATE_ALBUMS_TABLE)
+    create_table(conn, CREATE_TRACKS_TABLE)
+    create_table(conn, CREATE_ARTISTS_TABLE)
+    create_table(conn, CREATE_ARTIST_GENRE_TABLE)
+    create_table(conn, CREATE_ALBUM_ARTIST_TABLE)
+    create_table(conn, CREATE_ALBUM_TRACK_TABLE)
+    create_table(conn, CREATE_TRACK_ARTIST_TABLE)
+    migrate(conn)
+
+
+# Apply the migrations that haven't been applied to the new release database yet, each in its own transaction
+def migrate(conn):
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+
+    for number, statements in enumerate(MIGRATIONS[version:], start=version + 1):
+        conn.execute("BEGIN")
+        with conn:
+            for statement in statements:
+                if callable(statement):
+                    statement(conn)
+                else:
+                    conn.execute(statement)
+            conn.execute("PRAGMA user_version = " + str(number))
+        print("Applied migration " + str(number))
+
+
 # Connect to local database storing new release data, creating file and database design if it doesn't already exist
-def create_sqlite_connection():
-    if os.path.isfile(SQLITE_PATH):
+def create_sqlite_connection(db_path):
+    if os.path.isfile(db_path):
         print("SQLite file exists")
-        conn = _connect(SQLITE_PATH)
+        conn = _connect(db_path)
+        tune_connection(conn)
+        migrate(conn)
     else:
         print("SQLite file created")
-        conn = _connect(SQLITE_PATH)
-        create_table(conn, CREATE_ALBUMS_TABLE)
-        create_table(conn, CREATE_TRACKS_TABLE)
-        create_table(conn, CREATE_ARTISTS_TABLE)
-        create_table(conn, CREATE_ARTIST_GENRE_TABLE)
-        create_table(conn, CREATE_ALBUM_ARTIST_TABLE)
-        create_table(conn, CREATE_ALBUM_TRACK_TABLE)
-        create_table(conn, CREATE_TRACK_ARTIST_TABLE)
+        conn = _connect(db_path)
+        tune_connection(conn)
+        create_release_tables(conn)
     return conn
 
 
+# Get artists from the given ids that were fetched from the API less than ttl_days ago, keyed by ArtistID
+def get_cached_artists(conn, artist_ids, ttl_days):
+    cutoff = (datetime.now() - timedelta(days=ttl_days)).strftime(TIMESTAMP_FORMAT)
+    artist_ids = list(artist_ids)
+    artists = {}
+
+    for i in range(0, len(artist_ids), MAX_QUERY_IDS):
+        chunk = artist_ids[i:i + MAX_QUERY_IDS]
+        placeholders = ", ".join("?" * len(chunk))
+        rows = conn.execute("SELECT Artists.ArtistID, Name, Popularity FROM Artists "
+                            "INNER JOIN Artist_Cache ON Artists.ArtistID = Artist_Cache.ArtistID "
+                            "WHERE Artists.ArtistID IN (" + placeholders + ") AND FetchedAt >= ?",
+                            chunk + [cutoff])
+        for artist_id, name, popularity in rows:
+            artists[artist_id] = {"id": artist_id, "name": name, "popularity": popularity, "genres": []}
+
+    fresh_ids = list(artists)
+    for i in range(0, len(fresh_ids), MAX_QUERY_IDS):
+        chunk = fresh_ids[i:i + MAX_QUERY_IDS]
+        placeholders = ", ".join("?" * len(chunk))
+        rows = conn.execute("SELECT ArtistID, Genre FROM Artist_Genre WHERE ArtistID IN (" + placeholders + ")",
+                            chunk)
+        for artist_id, genre in rows:
+            artists[artist_id]["genres"].append(genre)
+
+    return artists
+
+
+# Get the ids from the given release ids that were collected by a previous run
+def get_seen_releases(conn, release_ids):
+    release_ids = list(release_ids)
+    seen_ids = set()
+
+    # Albums collected before releases were recorded in Seen_Releases are still recognised
+    for i in range(0, len(release_ids), MAX_QUERY_IDS):
+        chunk = release_ids[i:i + MAX_QUERY_IDS]
+        placeholders = ", ".join("?" * len(chunk))
+        rows = conn.execute("SELECT ReleaseID FROM Seen_Releases WHERE ReleaseID IN (" + placeholders + ") "
+                            "UNION SELECT AlbumID FROM Albums WHERE AlbumID IN (" + placeholders + ")",
+                            chunk + chunk)
+        seen_ids.update(release_id for release_id, in rows)
+
+    return seen_ids
+
+
+# Record the given release ids as collected, so that later runs can stop paging once they reach them
+def mark_releases_seen(conn, release_ids, collection_date):
+    conn.executemany("INSERT OR IGNORE INTO Seen_Releases (ReleaseID, CollectionDate) VALUES (?, ?)",
+                     [(release_id, collection_date) for release_id in release_ids])
+
+
+# Record the markets whose feed listed each release, given as lists of release ids keyed by market
+def mark_release_markets(conn, market_release_ids, collection_date):
+    conn.executemany("INSERT OR IGNORE INTO Release_Market (ReleaseID, Market, CollectionDate) VALUES (?, ?, ?)",
+                     [(release_id, market, collection_date)
+                      for market, release_ids in market_release_ids.items() for release_id in release_ids])
+
+
+# Check whether any albums or singles were collected on the given date
+def has_releases(conn, collection_date):
+    return conn.execute("SELECT EXISTS (SELECT 1 FROM Release_Digest WHERE CollectionDate = ?)",
+                        (collection_date,)).fetchone()[0] == 1
+
+
+# Check whether emails of the releases collected on the given date were already queued
+def has_queued_emails(conn, collection_date):
+    return conn.execute("SELECT EXISTS (SELECT 1 FROM Outbox WHERE CollectionDate = ?)",
+                        (collection_date,)).fetchone()[0] == 1
+
+
+# Overwrite stored details of artists that were just fetched from the API and mark them as fresh
+def refresh_artists(conn, artists):
+    fetched_at = datetime.now().strftime(TIMESTAMP_FORMAT)
+    conn.executemany("UPDATE Artists SET Name = ?, Popularity = ? WHERE ArtistID = ?",
+                     [(artist["name"], artist["popularity"], artist["id"]) for artist in artists])
+
+    # Stale genres are removed here; current genres are inserted along with the rest of the run's data
+    conn.executemany("DELETE FROM Artist_Genre WHERE ArtistID = ?",
+                     [(artist["id"],) for artist in artists])
+
+    conn.executemany("INSERT OR REPLACE INTO Artist_Cache (ArtistID, FetchedAt) VALUES (?, ?)",
+                     [(artist["id"], fetched_at) for artist in artists])
+
+
+# Get the albums and singles collected on the given date that any of the given artists took part in, as lists of
+# AlbumIDs and TrackIDs
+def get_releases_of_artists(conn, artist_ids, collection_date):
+    artist_ids = list(artist_ids)
+    album_ids = set()
+    track_ids = set()
+
+    for i in range(0, len(artist_ids), MAX_QUERY_IDS):
+        chunk = artist_ids[i:i + MAX_QUERY_IDS]
+        placeholders = ", ".join("?" * len(chunk))
+        rows = conn.execute(ARTIST_ALBUMS_QUERY.format(ids=placeholders),
+                            chunk + [collection_date] + chunk + [collection_date])
+        album_ids.update(album_id for album_id, in rows)
+
+        rows = conn.execute(ARTIST_SINGLES_QUERY.format(ids=placeholders), chunk + [collection_date])
+        track_ids.update(track_id for track_id, in rows)
+
+    return list(album_ids), list(track_ids)
+
+
+# Get the genres of the given artists, keyed by ArtistID
+def _get_artist_genres(conn, artist_ids):
+    artist_ids = list(artist_ids)
+    genres = {}
+
+    for i in range(0, len(artist_ids), MAX_QUERY_IDS):
+        chunk = artist_ids[i:i + MAX_QUERY_IDS]
+        placeholders = ", ".join("?" * len(chunk))
+        rows = conn.execute("SELECT ArtistID, Genre FROM Artist_Genre WHERE ArtistID IN (" + placeholders + ") "
+                            "ORDER BY ArtistID, Genre", chunk)
+        for artist_id, genre in rows:
+            genres.setdefault(artist_id, []).append(genre)
+
+    return genres
+
+
+# Get the de-duplicated genres of the given artists, in the order of the artists
+def _release_genres(artist_genres, artist_ids):
+    genres = []
+    for artist_id in artist_ids:
+        genres.extend(artist_genres.get(artist_id, []))
+    return list(dict.fromkeys(genres))
+
+
+# Build the digest rows of the given albums out of their stored albums, tracks and artists
+def _album_digest_rows(conn, album_ids):
+    albums = {}
+    for i in range(0, len(album_ids), MAX_QUERY_IDS):
+        chunk = album_ids[i:i + MAX_QUERY_IDS]
+        placeholders = ", ".join("?" * len(chunk))
+        rows = conn.execute("SELECT Albums.AlbumID, CollectionDate, Albums.Name, ReleaseDate, ImageURL, "
+                            "Artists.ArtistID, Artists.Name, Popularity FROM Albums "
+                            "INNER JOIN Album_Artist ON Albums.AlbumID = Album_Artist.AlbumID "
+                            "INNER JOIN Artists ON Album_Artist.ArtistID = Artists.ArtistID "
+                            "WHERE Albums.AlbumID IN (" + placeholders + ") "
+                            "ORDER BY Albums.AlbumID, Popularity DESC, Album_Artist.rowid", chunk)
+        for album_id, collection_date, name, release_date, image_url, artist_id, artist_name, popularity in rows:
+            album = albums.get(album_id)
+            if album is None:
+                album = albums[album_id] = {"collection_date": collection_date, "name": name,
+                                            "release_date": release_date, "image_url": image_url,
+                                            "popularity": popularity, "artist_ids": [], "artists": [], "tracks": {}}
+            album["artist_ids"].append(artist_id)
+            album["artists"].append(artist_name)
+
+        # Artists of each track are listed in the order the API listed them
+        rows = conn.execute("SELECT Album_Track.AlbumID, Tracks.TrackID, TrackNumber, Tracks.Name, PreviewURL, "
+                            "Artists.Name FROM Album_Track "
+                            "INNER JOIN Tracks ON Album_Track.TrackID = Tracks.TrackID "
+                            "INNER JOIN Track_Artist ON Tracks.TrackID = Track_Artist.TrackID "
+                            "INNER JOIN Artists ON Track_Artist.ArtistID = Artists.ArtistID "
+                            "WHERE Album_Track.AlbumID IN (" + placeholders + ") "
+                            "ORDER BY Album_Track.AlbumID, TrackNumber, Tracks.TrackID, Track_Artist.rowid", chunk)
+        for album_id, track_id, number, name, preview_url, artist_name in rows:
+            if album_id not in albums:
+                continue
+            tracks = albums[album_id]["tracks"]
+            track = tracks.get(track_id)
+            if track is None:
+                track = tracks[track_id] = {"number": number, "name": name, "preview_url": preview_url,
+                                            "artists": []}
+            track["artists"].append(artist_name)
+
+    artist_genres = _get_artist_genres(conn, {artist_id for album in albums.values()
+                                              for artist_id in album["artist_ids"]})
+
+    digest_rows = []
+    for album_id, album in albums.items():
+        tracks = list(album["tracks"].values())
+        for track in tracks:
+            track["featured"] = [artist for artist in track["artists"] if artist not in album["artists"]]
+        digest_rows.append((album["collection_date"], album_id, "Album", album["name"], album["release_date"],
+                            album["image_url"], None, album["popularity"], json.dumps(album["artist_ids"]),
+                            json.dumps(album["artists"]), json.dumps(tracks),
+                            json.dumps(_release_genres(artist_genres, album["artist_ids"]))))
+    return digest_rows
+
+
+# Build the digest rows of the given singles out of their stored tracks and artists
+def _single_digest_rows(conn, track_ids):
+    singles = {}
+    for i in range(0, len(track_ids), MAX_QUERY_IDS):
+        chunk = track_ids[i:i + MAX_QUERY_IDS]
+        placeholders = ", ".join("?" * len(chunk))
+        rows = conn.execute("SELECT Tracks.TrackID, SingleCollectionDate, Tracks.Name, PreviewURL, "
+                            "SingleReleaseDate, SingleImageURL, Artists.ArtistID, Artists.Name, Popularity "
+                            "FROM Tracks "
+                            "INNER JOIN Track_Artist ON Tracks.TrackID = Track_Artist.TrackID "
+                            "INNER JOIN Artists ON Track_Artist.ArtistID = Artists.ArtistID "
+                            "WHERE Tracks.TrackID IN (" + placeholders + ") AND SingleCollectionDate IS NOT NULL "
+                            "ORDER BY Tracks.TrackID, Popularity DESC, Track_Artist.rowid", chunk)
+        for (track_id, collection_date, name, preview_url, release_date, image_url, artist_id, artist_name,
+             popularity) in rows:
+            single = singles.get(track_id)
+            if single is None:
+                single = singles[track_id] = {"collection_date": collection_date, "name": name,
+                                              "preview_url": preview_url, "release_date": release_date,
+                                              "image_url": image_url, "popularity": popularity, "artist_ids": [],
+                                              "artists": []}
+            single["artist_ids"].append(artist_id)
+            single["artists"].append(artist_name)
+
+    artist_genres = _get_artist_genres(conn, {artist_id for single in singles.values()
+                                              for artist_id in single["artist_ids"]})
+
+    return [(single["collection_date"], track_id, "Single", single["name"], single["release_date"],
+             single["image_url"], single["preview_url"], single["popularity"], json.dumps(single["artist_ids"]),
+             json.dumps(single["artists"]), "[]", json.dumps(_release_genres(artist_genres, single["artist_ids"])))
+            for track_id, single in singles.items()]
+
+
+# Insert the given digest rows, updating the rows of releases that are already in the digest in place so that they
+# keep their rowid
+def _store_digest_rows(conn, rows):
+    conn.executemany("INSERT INTO Release_Digest (CollectionDate, ReleaseID, ReleaseType, Name, ReleaseDate, "
+                     "ImageURL, PreviewURL, Popularity, ArtistIDs, Artists, Tracks, Genres) "
+                     "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?) "
+                     "ON CONFLICT (CollectionDate, ReleaseID) DO UPDATE SET ReleaseType = excluded.ReleaseType, "
+                     "Name = excluded.Name, ReleaseDate = excluded.ReleaseDate, ImageURL = excluded.ImageURL, "
+                     "PreviewURL = excluded.PreviewURL, Popularity = excluded.Popularity, "
+                     "ArtistIDs = excluded.ArtistIDs, Artists = excluded.Artists, Tracks = excluded.Tracks, "
+                     "Genres = excluded.Genres", rows)
+
+
+# Rebuild the digest rows of the given albums and singles (given by AlbumID and TrackID) from the stored data,
+# e.g. after they were inserted or the details of their artists were refreshed, along with their search index
+def refresh_release_digest(conn, album_ids, track_ids):
+    rows = _album_digest_rows(conn, list(album_ids)) + _single_digest_rows(conn, list(track_ids))
+    _store_digest_rows(conn, rows)
+    conn.executemany("INSERT OR REPLACE INTO Release_Search (rowid, Name, Artists, Tracks, Genres) " +
+                     RELEASE_SEARCH_TEXT_QUERY + " WHERE CollectionDate = ? AND ReleaseID = ?",
+                     [(row[0], row[1]) for row in rows])
+
+
+# Build the digest of every album and single stored in the new release database (the search index is built from
+# it by the migration that adds it)
+def backfill_release_digest(conn):
+    album_ids = [album_id for album_id, in conn.execute("SELECT AlbumID FROM Albums")]
+    track_ids = [track_id for track_id, in conn.execute("SELECT TrackID FROM Tracks "
+                                                        "WHERE SingleCollectionDate IS NOT NULL")]
+    _store_digest_rows(conn, _album_digest_rows(conn, album_ids) + _single_digest_rows(conn, track_ids))
+
+
+# Build an FTS5 query matching releases that contain every word of the given text, in the given column of the search
+# index if there is one; words are quoted so that characters of the query syntax in the text are matched literally
+def _search_query(text, column=None):
+    words = ['"' + word.replace('"', '""') + '"' for word in text.split()]
+    if not words:
+        raise Exception("Nothing to search for")
+    if column not in (None,) + RELEASE_SEARCH_COLUMNS:
+        raise Exception("Unknown search column: " + str(column))
+    query = " AND ".join(words)
+    if column:
+        return column + " : (" + query + ")"
+    return query
+
+
+# Search the releases in the digest for the given text (in one of the columns of the search index: Name, Artists,
+# Tracks or Genres, or in all of them), returning the given page of matches, best matches first
+def search_releases(conn, text, column=None, page=1, page_size=20):
+    if page < 1 or page_size < 1:
+        raise Exception("Page and page size must be at least 1")
+
+    # The page is picked from the index alone, so that only the releases on it are looked up in the digest
+    rows = conn.execute("SELECT CollectionDate, ReleaseID, ReleaseType, Name, Artists, ReleaseDate FROM ("
+                        "SELECT rowid, rank FROM Release_Search WHERE Release_Search MATCH ? "
+                        "ORDER BY rank LIMIT ? OFFSET ?) AS Matches "
+                        "INNER JOIN Release_Digest ON Release_Digest.rowid = Matches.rowid "
+                        "ORDER BY Matches.rank",
+                        (_search_query(text, column), page_size, (page - 1) * page_size))
+    return [{"collection_date": collection_date, "release_id": release_id, "release_type": release_type,
+             "name": name, "artists": json.loads(artists), "release_date": release_date}
+            for collection_date, release_id, release_type, name, artists, release_date in rows]
+
+
+# Insert the rows whose key isn't already in the given table, returning the keys that were new
+# (the rows are staged in a temporary table so that existing rows are found with index lookups)
+def insert_new_rows(conn, table, columns, key_columns, rows):
+    staging_table = "temp.Staging_" + table
+    column_list = ", ".join(columns)
+    key_list = ", ".join(key_columns)
+    key_match = " AND ".join(table + "." + key + " = Staging." + key for key in key_columns)
+
+    conn.execute("CREATE TABLE IF NOT EXISTS " + staging_table + " AS SELECT " + column_list + " FROM main." + table +
+                 " WHERE 0")
+    conn.execute("DELETE FROM " + staging_table)
+    conn.executemany("INSERT INTO " + staging_table + " (" + column_list + ") VALUES (" +
+                     ", ".join("?" * len(columns)) + ")", rows)
+
+    new_keys = conn.execute("SELECT DISTINCT " + key_list + " FROM " + staging_table + " AS Staging " +
+                            "WHERE NOT EXISTS (SELECT 1 FROM main." + table + " WHERE " + key_match + ")").fetchall()
+
+    # The first staged row of each key wins when a key occurs more than once in this run
+    conn.execute("INSERT OR IGNORE INTO main." + table + " (" + column_list + ") " +
+                 "SELECT " + column_list + " FROM " + staging_table + " ORDER BY rowid")
+    conn.execute("DELETE FROM " + staging_table)
+
+    if len(key_columns) == 1:
+        return [key[0] for key in new_keys]
+    return new_keys
+
+
 # Connect to local configuration database (this must already exist; the application doesn't create it)
-def create_config_connection():
-    if os.path.isfile(CONFIG_DB_PATH):
+def create_config_connection(db_path):
+    if os.path.isfile(db_path):
         print("Config database exists")
-        conn = _connect(CONFIG_DB_PATH)
+        conn = _connect(db_path)
+        create_table(conn, CREATE_RECIPIENT_PREFERENCES_TABLE)
     else:
         raise Exception("Config database doesn't exist")
     return conn
+
+
+# Connect to the local database storing new release data without being able to write to it, e.g. to read it while
+# a run is collecting into it (reads don't block on its writes thanks to write-ahead logging)
+def create_read_only_connection(db_path):
+    if not os.path.isfile(db_path):
+        raise Exception("New release database doesn't exist")
+    conn = sqlite3.connect(pathlib.Path(db_path).resolve().as_uri() + "?mode=ro", uri=True)
+    conn.execute("PRAGMA mmap_size = 268435456")
+    return conn
+
+
+# Get every date releases were collected on, in order
+def get_collection_dates(conn):
+    rows = conn.execute("SELECT CollectionDate FROM Albums "
+                        "UNION SELECT SingleCollectionDate FROM Tracks WHERE SingleCollectionDate IS NOT NULL "
+                        "ORDER BY 1")
+    return [collection_date for collection_date, in rows]
+
+
+# Get the path of the HTTP cache database, which is kept next to the new release database
+def http_cache_path(release_db_path):
+    root, extension = os.path.splitext(release_db_path)
+    return root + "_HTTP_Cache" + (extension or ".sqlite")
+
+
+# Connect to the local database of the HTTP cache, creating it if it doesn't already exist; the connection is shared
+# by the threads sending API requests, which take turns using it, and commits every statement on its own
+def create_http_cache_connection(db_path):
+    conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.execute("PRAGMA synchronous = NORMAL")
+    create_table(conn, CREATE_HTTP_CACHE_TABLE)
+    create_table(conn, CREATE_HTTP_CACHE_LAST_USED_INDEX)
+    return conn
+
+
+# Get the (ETag, body, expiry time) of the cached response to the given url, or None if it isn't cached
+def get_cached_response(conn, url):
+    return conn.execute("SELECT ETag, Body, ExpiresAt FROM HTTP_Cache WHERE URL = ?", (url,)).fetchone()
+
+
+# Store the response to the given url, replacing any response previously cached for it
+def store_cached_response(conn, url, etag, body, expires_at, used_at):
+    conn.execute("INSERT OR REPLACE INTO HTTP_Cache (URL, ETag, Body, Size, ExpiresAt, LastUsedAt) "
+                 "VALUES (?, ?, ?, ?, ?, ?)", (url, etag, body, len(body), expires_at, used_at))
+
+
+# Record that the cached response to the given url was used, optionally extending its expiry time
+def touch_cached_response(conn, url, used_at, expires_at=None):
+    conn.execute("UPDATE HTTP_Cache SET LastUsedAt = ?, ExpiresAt = COALESCE(?, ExpiresAt) WHERE URL = ?",
+                 (used_at, expires_at, url))
+
+
+# Get the total size in bytes of the cached responses
+def get_http_cache_size(conn):
+    return conn.execute("SELECT COALESCE(SUM(Size), 0) FROM HTTP_Cache").fetchone()[0]
+
+
+# Delete the least recently used cached responses that don't fit in max_bytes, returning the number deleted
+def evict_cached_responses(conn, max_bytes):
+    return conn.execute("DELETE FROM HTTP_Cache WHERE URL IN (SELECT URL FROM ("
+                        "SELECT URL, SUM(Size) OVER (ORDER BY LastUsedAt DESC, URL) AS KeptSize FROM HTTP_Cache) "
+                        "WHERE KeptSize > ?)", (max_bytes,)).rowcount
+
+
+# Queue the given (idempotency key, collection date, recipients, message) emails for delivery, ignoring emails
+# whose idempotency key was already queued
+def queue_outbox_messages(conn, messages):
+    now = datetime.now().strftime(TIMESTAMP_FORMAT)
+    with conn:
+        conn.executemany("INSERT OR IGNORE INTO Outbox (IdempotencyKey, CollectionDate, Recipients, Message, Status, "
+                         "NextAttemptAt) VALUES (?, ?, ?, ?, 'Pending', ?)",
+                         [(key, collection_date, json.dumps(recipients), message, now)
+                          for key, collection_date, recipients, message in messages])
+
+
+# Get the queued emails that are due for a delivery attempt, as (message id, recipients, message, attempts) tuples
+def get_due_outbox_messages(conn):
+    now = datetime.now().strftime(TIMESTAMP_FORMAT)
+    rows = conn.execute("SELECT MessageID, Recipients, Message, Attempts FROM Outbox "
+                        "WHERE Status = 'Pending' AND NextAttemptAt <= ? ORDER BY MessageID", (now,))
+    return [(message_id, json.loads(recipients), message, attempts)
+            for message_id, recipients, message, attempts in rows]
+
+
+# Record that the queued email with the given id was delivered
+def mark_outbox_sent(conn, message_id):
+    with conn:
+        conn.execute("UPDATE Outbox SET Status = 'Sent', Attempts = Attempts + 1, LastError = NULL, SentAt = ? "
+                     "WHERE MessageID = ?", (datetime.now().strftime(TIMESTAMP_FORMAT), message_id))
+
+
+# Record a failed delivery attempt of the queued email with the given id, to be retried after retry_seconds,
+# or never again if retry_seconds is None
+def mark_outbox_failed(conn, message_id, error, retry_seconds):
+    if retry_seconds is None:
+        status = "Failed"
+        next_attempt_at = None
+    else:
+        status = "Pending"
+        next_attempt_at = (datetime.now() + timedelta(seconds=retry_seconds)).strftime(TIMESTAMP_FORMAT)
+    with conn:
+        conn.execute("UPDATE Outbox SET Status = ?, Attempts = Attempts + 1, NextAttemptAt = ?, LastError = ? "
+                     "WHERE MessageID = ?", (status, next_attempt_at, error, message_id))
+
+
+# Get the genres and artist ids each recipient wants to be notified about, keyed by email address
+def get_recipient_preferences(config_conn):
+    preferences = {}
+    for email_address, preference_type, value in config_conn.execute(
+            "SELECT EmailAddress, PreferenceType, Value FROM Recipient_Preferences"):
+        recipient = preferences.setdefault(email_address, {"genres": set(), "artist_ids": set()})
+        if preference_type == "Genre":
+            recipient["genres"].add(value)
+        else:
+            recipient["artist_ids"].add(value)
+    return preferences
+
+
+# DatabaseSession opens the local databases once per run, so that every stage of the run shares the same warm
+# connections, and closes them when the run is over
+class DatabaseSession:
+
+    def __init__(self, config):
+        self.config = config
+        self.conn = None
+        self._config_conn = None
+        self._http_cache_conn = None
+
+    def __enter__(self):
+        self.conn = create_sqlite_connection(self.config.new_release_db_path)
+        run_metrics.watch_connection(self.conn, "new_release_db")
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    # Connection to local configuration database, opened the first time it is needed
+    @property
+    def config_conn(self):
+        if self._config_conn is None:
+            self._config_conn = create_config_connection(self.config.config_db_path)
+            run_metrics.watch_connection(self._config_conn, "config_db")
+        return self._config_conn
+
+    # Connection to the local database of the HTTP cache, opened the first time it is needed; it isn't watched by
+    # run_metrics because it is used from the threads sending API requests
+    @property
+    def http_cache_conn(self):
+        if self._http_cache_conn is None:
+            self._http_cache_conn = create_http_cache_connection(http_cache_path(self.config.new_release_db_path))
+        return self._http_cache_conn
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+        if self._config_conn is not None:
+            self._config_conn.close()
+            self._config_conn = None
+        if self._http_cache_conn is not None:
+            self._http_cache_conn.close()
+            self._http_cache_conn = None
@@ -0,0 +1,74 @@
+import email_notifier
+
+import exporter
+
+import sql_utils
+
+import sqlite3
+
+import unittest
+
+
+# The hot queries of the new release database are planned by SQLite on a fresh database with every migration
+# applied, which has no statistics, just like the databases the notifier creates, and must search the indexes added
+# for them instead of scanning whole tables
+class QueryPlanTest(unittest.TestCase):
+
+    def setUp(self):
+        self.conn = sqlite3.connect(":memory:")
+        sql_utils.create_release_tables(self.conn)
+
+    def tearDown(self):
+        self.conn.close()
+
+    def plan(self, query, parameters):
+        return [row[3] for row in self.conn.execute("EXPLAIN QUERY PLAN " + query, parameters)]
+
+    def assertSearches(self, plan, indexes):
+        for step in plan:
+            self.assertFalse(step.startswith("SCAN "), "Query scans a whole table: " + str(plan))
+        for index in indexes:
+            self.assertTrue(any(" INDEX " + index + " " in step for step in plan),
+                            "Query doesn't use index " + index + ": " + str(plan))
+
+    # The unary + on the collection dates makes SQLite find an artist's releases through the artist's relationships
+    # rather than through every release collected on the date
+    def test_releases_of_artists_are_found_through_their_artists(self):
+        placeholders = ", ".join("?" * 3)
+
+        plan = self.plan(sql_utils.ARTIST_ALBUMS_QUERY.format(ids=placeholders), ["artist"] * 3 + ["date"] +
+                         ["artist"] * 3 + ["date"])
+        self.assertSearches(plan, ["Album_Artist_ArtistID", "Track_Artist_ArtistID", "Album_Track_TrackID",
+                                   "sqlite_autoindex_Albums_1"])
+        self.assertNotIn("Albums_CollectionDate", " ".join(plan))
+
+        plan = self.plan(sql_utils.ARTIST_SINGLES_QUERY.format(ids=placeholders), ["artist"] * 3 + ["date"])
+        self.assertSearches(plan, ["Track_Artist_ArtistID", "sqlite_autoindex_Tracks_1"])
+        self.assertNotIn("Tracks_SingleCollectionDate", " ".join(plan))
+
+    def test_digest_is_read_with_a_range_of_its_primary_key(self):
+        plan = self.plan(email_notifier.DIGEST_QUERY, ["date"])
+        self.assertSearches(plan, ["sqlite_autoindex_Release_Digest_1"])
+
+    # Every exported table is read through the releases collected on the partition's date
+    def test_export_queries_search_the_collection_date_indexes(self):
+        expected_indexes = {
+            "Albums": ["Albums_CollectionDate"],
+            "Tracks": ["sqlite_autoindex_Tracks_1", "Tracks_SingleCollectionDate", "Albums_CollectionDate"],
+            "Artists": ["sqlite_autoindex_Artists_1", "Tracks_SingleCollectionDate", "Albums_CollectionDate"],
+            "Artist_Genre": ["sqlite_autoindex_Artist_Genre_1", "Tracks_SingleCollectionDate",
+                             "Albums_CollectionDate"],
+            "Album_Artist": ["sqlite_autoindex_Album_Artist_1", "Albums_CollectionDate"],
+            "Album_Track": ["sqlite_autoindex_Album_Track_1", "Albums_CollectionDate"],
+            "Track_Artist": ["sqlite_autoindex_Track_Artist_1", "Tracks_SingleCollectionDate", "Albums_CollectionDate"]
+        }
+        self.assertEqual(set(expected_indexes), set(exporter.EXPORT_QUERIES))
+
+        for table, query in exporter.EXPORT_QUERIES.items():
+            with self.subTest(table=table):
+                plan = self.plan(query.format(columns="*"), {"date": "date"})
+                self.assertSearches(plan, expected_indexes[table])
+
+
+if __name__ == "__main__":
+    unittest.main()
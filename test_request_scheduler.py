@@ -0,0 +1,138 @@
+from http_cache import CachingSession, HTTPCache
+
+from request_scheduler import RequestScheduler, TokenBucket
+
+import sql_utils
+
+import spotipy
+from spotipy.exceptions import SpotifyException
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import json
+
+import threading
+
+import time
+
+import unittest
+
+
+# FakeSpotifyServer is a local HTTP server answering Spotify API requests for artists, taking RESPONSE_SECONDS to
+# answer each one, which rate limits the first request it receives and always fails requests for the artist "broken"
+class FakeSpotifyServer(ThreadingHTTPServer):
+
+    RESPONSE_SECONDS = 0.05
+    RETRY_AFTER = 1
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), FakeSpotifyHandler)
+        self.lock = threading.Lock()
+        self.rate_limited_at = None
+        self.served_at = []
+        self.failed_count = 0
+
+
+class FakeSpotifyHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        now = time.monotonic()
+        with server.lock:
+            if self.path.startswith("/v1/artists/broken"):
+                server.failed_count += 1
+                status = 503
+            elif server.rate_limited_at is None:
+                server.rate_limited_at = now
+                status = 429
+            else:
+                server.served_at.append(now)
+                status = 200
+
+        if status == 503:
+            self._respond(503, {"error": {"status": 503, "message": "Service unavailable"}})
+        elif status == 429:
+            self._respond(429, {"error": {"status": 429, "message": "API rate limit exceeded"}},
+                          {"Retry-After": str(server.RETRY_AFTER)})
+        else:
+            time.sleep(server.RESPONSE_SECONDS)
+            self._respond(200, {"id": self.path.rsplit("/", 1)[-1]})
+
+    def _respond(self, status, body, headers=None):
+        content = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(content)
+
+
+class TokenBucketTest(unittest.TestCase):
+
+    # A rate below one per second lets a request through every 1 / rate seconds instead of blocking forever
+    def test_rate_below_one_per_second(self):
+        bucket = TokenBucket(4 / 7)
+
+        start = time.monotonic()
+        bucket.acquire()
+        bucket.acquire()
+
+        self.assertAlmostEqual(time.monotonic() - start, 7 / 4, delta=0.2)
+
+    def test_rate_must_be_positive(self):
+        for rate in (0, -1):
+            with self.assertRaises(Exception):
+                TokenBucket(rate)
+
+
+# Requests go through the same Spotipy client, HTTP session and scheduler as APIClient's, to a fake Spotify server
+class RequestSchedulerTest(unittest.TestCase):
+
+    WORKERS = 4
+
+    def setUp(self):
+        self.server = FakeSpotifyServer()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+        self.cache_conn = sql_utils.create_http_cache_connection(":memory:")
+        self.sp = spotipy.Spotify(auth="token", requests_session=CachingSession(HTTPCache(self.cache_conn, 1000000)))
+        self.sp.prefix = "http://127.0.0.1:" + str(self.server.server_port) + "/v1/"
+
+        self.scheduler = RequestScheduler(self.WORKERS, 1000, 3)
+        self.scheduler.BASE_BACKOFF = 0.01
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.cache_conn.close()
+
+    # Once a request is rate limited, no worker sends another request until its Retry-After is over (requests sent
+    # before the 429 arrived are only received right after it)
+    def test_rate_limited_requests_pause_every_worker(self):
+        artist_ids = ["artist" + str(number) for number in range(self.WORKERS * 4)]
+
+        results = self.scheduler.map(self.sp.artist, [(artist_id,) for artist_id in artist_ids])
+
+        self.assertEqual([result["id"] for result in results], artist_ids)
+        self.assertEqual(len(self.server.served_at), len(artist_ids))
+        waited = [served_at - self.server.rate_limited_at for served_at in self.server.served_at]
+        self.assertEqual([seconds for seconds in waited if 0.05 < seconds < FakeSpotifyServer.RETRY_AFTER], [])
+
+    # Server errors are retried by the scheduler alone, not by the HTTP session as well
+    def test_server_errors_are_retried_by_the_scheduler_only(self):
+        self.server.rate_limited_at = 0
+
+        with self.assertRaises(SpotifyException) as raised:
+            self.scheduler.call(self.sp.artist, "broken")
+
+        self.assertEqual(raised.exception.http_status, 503)
+        self.assertEqual(self.server.failed_count, self.scheduler.max_retries + 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,62 @@
+from metrics import run_metrics
+
+import threading
+
+import time
+
+
+# TokenManager obtains tokens for the Spotify API with the client credentials flow, which needs no user
+# interaction, and keeps the current token in memory, obtaining a new one shortly before it expires; Spotipy asks it
+# for the token before every request, so clients kept across runs never send an expired token
+class TokenManager:
+
+    TOKEN_URL = "https://accounts.spotify.com/api/token"
+
+    # Seconds before its expiry that a token is replaced, so that requests in flight don't carry an expired token
+    REFRESH_MARGIN = 60
+
+    # Seconds to wait for the token endpoint
+    TIMEOUT = 10
+
+    def __init__(self, client_id, client_secret, http_session):
+        self.client_id = client_id
+        self.client_secret = client_secret
+
+        # Tokens are requested through the same pooled session as the API requests
+        self.http_session = http_session
+
+        self.lock = threading.Lock()
+        self.token = None
+        self.expires_at = 0
+
+    # Get a token that is valid for at least REFRESH_MARGIN more seconds, obtaining a new one if the current one
+    # isn't; the request threads share the token, and only one of them obtains a new one
+    def get_access_token(self, as_dict=False):
+        with self.lock:
+            if self.token is None or time.monotonic() >= self.expires_at - self.REFRESH_MARGIN:
+                self._request_token()
+            return self.token
+
+    # The client secret is only sent in the Authorization header of the request, and neither it nor the token is
+    # ever printed or included in an exception
+    def _request_token(self):
+        start = time.perf_counter()
+        try:
+            response = self.http_session.post(self.TOKEN_URL, data={"grant_type": "client_credentials"},
+                                              auth=(self.client_id, self.client_secret), timeout=self.TIMEOUT)
+        except Exception as e:
+            run_metrics.record_request("request_token", time.perf_counter() - start, 0, failed=True)
+            raise Exception("Can't get token: " + str(e))
+
+        failed = response.status_code != 200
+        run_metrics.record_request("request_token", time.perf_counter() - start, 0, failed=failed)
+        if failed:
+            try:
+                error = response.json().get("error", "")
+            except ValueError:
+                error = ""
+            raise Exception("Can't get token: HTTP " + str(response.status_code) + (" " + error if error else ""))
+
+        token = response.json()
+        self.token = token["access_token"]
+        self.expires_at = time.monotonic() + token["expires_in"]